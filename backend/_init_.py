@@ -1,44 +1,159 @@
+import time
+_imports_started = time.perf_counter()
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from .database import init_db
-from .authentication import AuthManager
+from . import database
+from .database import init_db, remove_session
+from .authentication import AuthManager, token_cache
+from .crypto_utils import CryptoManager, PasswordHasher
 from .graph_utils import NetworkGraph
 from .message_handler import MessageHandler
+from .workers import PeriodicWorker
+from .ingest import MessageIngestQueue
+from .retention import RetentionPurger
+from .startup import StartupTimer
+import atexit
+
+# How long importing the backend (and everything it pulls in) took
+IMPORT_SECONDS = time.perf_counter() - _imports_started
 
 db_session = None
 auth_manager = None
 graph_manager = None
 message_handler = None
 
-def create_app(config=None):
+def create_app(config=None, socketio=None):
+    timer = StartupTimer()
+    timer.add('imports', IMPORT_SECONDS)
     app = Flask(__name__)
     
     # Load configuration
-    if config:
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config:
         app.config.from_object(config)
     else:
         app.config.from_object('config.Config')
 
+    # Message keys get their own secret: never the session key or a default
+    master_key = app.config.get('ENCRYPTION_MASTER_KEY')
+    if not master_key and not (app.config.get('DEBUG') or app.config.get('TESTING')):
+        raise RuntimeError("ENCRYPTION_MASTER_KEY must be set")
+
     # Enable CORS
     CORS(app)
 
-    # Initialize database
+    # Initialize database; db_session is a scoped_session, so each thread
+    # gets its own session and returns it to the pool on teardown
     global db_session
-    db_session = init_db()
+    with timer.phase('database'):
+        db_session = init_db(app.config)
+    app.teardown_appcontext(remove_session)
 
     # Initialize managers
     global auth_manager, graph_manager, message_handler
-    auth_manager = AuthManager(db_session)
-    graph_manager = NetworkGraph(db_session)
-    message_handler = MessageHandler(db_session, graph_manager)
+    password_hasher = PasswordHasher(rounds=app.config.get('BCRYPT_ROUNDS', 12),
+                                     max_workers=app.config.get('AUTH_WORKERS', 4),
+                                     max_pending=app.config.get('AUTH_MAX_PENDING', 32),
+                                     timeout=app.config.get('AUTH_TIMEOUT', 10.0))
+    auth_manager = AuthManager(db_session, password_hasher=password_hasher)
+    token_cache.maxsize = app.config.get('TOKEN_CACHE_SIZE', 1024)
+    graph_class = NetworkGraph
+    if app.config.get('GRAPH_BACKEND', 'networkx') == 'csr':
+        from .csr_graph import CSRNetworkGraph
+        graph_class = CSRNetworkGraph
+    # Loads the whole topology from the database
+    with timer.phase('graph'):
+        graph_manager = graph_class(db_session,
+                                    route_cache_size=app.config.get('ROUTE_CACHE_SIZE', 512),
+                                    centrality_sample_threshold=app.config.get('CENTRALITY_SAMPLE_THRESHOLD', 1000),
+                                    centrality_sample_size=app.config.get('CENTRALITY_SAMPLE_SIZE', 256),
+                                    centrality_background=app.config.get('CENTRALITY_BACKGROUND', False),
+                                    max_paths=app.config.get('PATH_ENUM_MAX_PATHS', 100),
+                                    max_path_hops=app.config.get('PATH_ENUM_MAX_HOPS'),
+                                    path_timeout=app.config.get('PATH_ENUM_TIMEOUT', 2.0),
+                                    change_log_size=app.config.get('GRAPH_CHANGE_LOG_SIZE', 10000),
+                                    diameter_exact_limit=app.config.get('NETWORK_DIAMETER_EXACT_LIMIT', 1000),
+                                    diameter_sweeps=app.config.get('NETWORK_DIAMETER_SWEEPS', 4))
+    with timer.phase('messages'):
+        message_handler = MessageHandler(db_session, graph_manager,
+                                         page_size=app.config.get('MESSAGE_PAGE_SIZE', 50),
+                                         max_page_size=app.config.get('MAX_MESSAGE_PAGE_SIZE', 200),
+                                         retention_days=app.config.get('MESSAGE_RETENTION_DAYS'),
+                                         read_session=database.read_session,
+                                         crypto_manager=CryptoManager(
+                                             master_key,
+                                             key_cache_size=app.config.get('MESSAGE_KEY_CACHE_SIZE', 1024),
+                                             cipher=app.config.get('MESSAGE_CIPHER', 'aes-gcm')
+                                         ))
+
+    # Push new messages to receivers over SocketIO
+    if socketio is not None:
+        from .realtime import SocketIONotifier
+        message_handler.notifier = SocketIONotifier(socketio, db_session, graph_manager)
+        message_handler.notifier.register_handlers()
+        graph_manager.change_listeners.append(message_handler.notifier.graph_changed)
+
+    # Forward messages hop by hop through per-node relay queues
+    if app.config.get('RELAY_ENABLED', False):
+        from .relay import RelayEngine
+        message_handler.relay_engine = RelayEngine(
+            graph_manager,
+            link_latency=app.config.get('RELAY_LINK_LATENCY', 0.0),
+            max_retries=app.config.get('RELAY_MAX_RETRIES', 3),
+            retry_delay=app.config.get('RELAY_RETRY_DELAY', 0.05),
+            delivery_timeout=app.config.get('RELAY_TIMEOUT', 5.0)
+        ).start()
+        atexit.register(message_handler.relay_engine.stop)
+
+    # Group-commit incoming messages from a write-behind queue
+    if app.config.get('INGEST_QUEUE_ENABLED', False):
+        message_handler.ingest_queue = MessageIngestQueue(
+            message_handler,
+            maxsize=app.config.get('INGEST_QUEUE_SIZE', 10000),
+            batch_size=app.config.get('INGEST_BATCH_SIZE', 500),
+            max_delay=app.config.get('INGEST_MAX_DELAY', 0.01),
+            put_timeout=app.config.get('INGEST_PUT_TIMEOUT', 1.0),
+            ack_timeout=app.config.get('INGEST_ACK_TIMEOUT', 5.0),
+            teardown=remove_session
+        )
+        atexit.register(message_handler.ingest_queue.shutdown)
+
+    # Periodically rebuild the per-user message counters in case they drift
+    reconcile_interval = app.config.get('COUNTER_RECONCILE_INTERVAL')
+    if reconcile_interval:
+        PeriodicWorker('counter-reconciler', reconcile_interval,
+                       message_handler.reconcile_counters,
+                       teardown=remove_session).start()
+
+    # Delete (and optionally archive) messages past the retention period
+    purge_interval = app.config.get('RETENTION_PURGE_INTERVAL')
+    if purge_interval and app.config.get('MESSAGE_RETENTION_DAYS'):
+        purger = RetentionPurger(message_handler, app.config['MESSAGE_RETENTION_DAYS'],
+                                 batch_size=app.config.get('RETENTION_BATCH_SIZE', 500),
+                                 pause=app.config.get('RETENTION_BATCH_PAUSE', 0.05),
+                                 archive_path=app.config.get('RETENTION_ARCHIVE_PATH'))
+        PeriodicWorker('retention-purger', purge_interval, purger.purge,
+                       teardown=remove_session).start()
+        atexit.register(purger.stop)
+
+    # Apply topology changes made by other worker processes
+    sync_interval = app.config.get('GRAPH_SYNC_INTERVAL')
+    if sync_interval:
+        PeriodicWorker('graph-sync', sync_interval, graph_manager.sync_changes,
+                       teardown=remove_session).start()
 
-    # Create demo data if needed
+    # Create demo data if needed; a no-op once the network has data
     if app.config.get('CREATE_DEMO_DATA', False):
-        graph_manager.create_demo_graph()
+        with timer.phase('demo data'):
+            graph_manager.create_demo_graph()
 
     # Register blueprints
-    from frontend.routes import api
-    app.register_blueprint(api)
+    with timer.phase('routes'):
+        from frontend.routes import api
+        app.register_blueprint(api)
 
+    app.extensions['startup_timings'] = timer.log()
     return app
\ No newline at end of file
@@ -1,31 +1,124 @@
-from .crypto_utils import hash_password, verify_password
+from .crypto_utils import PasswordHasher, AuthOverloadedError
 from .database import Admin, User
+from .metrics import timed
+from collections import OrderedDict
 from functools import wraps
 from flask import session, redirect, url_for
+import hashlib
+import threading
+import time
 import jwt
 import datetime
 
 SECRET_KEY = 'your-secret-key'  # In production, use environment variable
 
+class TokenCache:
+    """LRU cache of verified token payloads, keyed by a digest of the token
+
+    Cached payloads are dropped once their exp claim passes. Tokens for a
+    user issued before invalidate_user was called are rejected even when
+    their signature is still valid.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._revoked_before = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token) -> bytes:
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.blake2b(token, digest_size=16).digest()
+
+    def is_revoked(self, payload: dict) -> bool:
+        """Check whether a payload predates its user's last invalidation"""
+        revoked_before = self._revoked_before.get((payload.get('user_id'), payload.get('is_admin')))
+        return revoked_before is not None and payload.get('iat', 0) < revoked_before
+
+    def get(self, token):
+        """Get a cached payload, or None if the token isn't cached or has expired"""
+        key = self._key(token)
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            if payload['exp'] <= time.time() or self.is_revoked(payload):
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload: dict):
+        """Cache a verified payload"""
+        if self.maxsize <= 0:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        """Drop a single token, e.g. on logout"""
+        with self._lock:
+            self._entries.pop(self._key(token), None)
+
+    def invalidate_user(self, user_id: int, is_admin: bool = False):
+        """Reject every token issued to a user so far, e.g. on password change"""
+        with self._lock:
+            self._revoked_before[(user_id, is_admin)] = time.time()
+            for key, payload in list(self._entries.items()):
+                if payload.get('user_id') == user_id and payload.get('is_admin') == is_admin:
+                    del self._entries[key]
+
+    def stats(self) -> dict:
+        """Get hit/miss counters and current size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
+
+token_cache = TokenCache()
+
 def generate_token(user_id, is_admin=False):
     """Generate JWT token for authenticated users"""
     payload = {
         'user_id': user_id,
         'is_admin': is_admin,
+        'iat': time.time(),  # Sub-second, so revocation can't catch a newer token
         'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
     }
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
 
 def verify_token(token):
     """Verify JWT token"""
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-        return payload
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+    if token_cache.is_revoked(payload):
+        return None
+    token_cache.put(token, payload)
+    return payload
+
 def login_required(f):
     """Decorator for routes that require authentication"""
     @wraps(f)
@@ -57,31 +150,56 @@ def admin_required(f):
     return decorated_function
 
 class AuthManager:
-    def __init__(self, db_session):
+    def __init__(self, db_session, password_hasher=None):
         self.db_session = db_session
+        # bcrypt runs on this bounded pool; it raises AuthOverloadedError
+        # from authenticate_* when saturated
+        self.password_hasher = password_hasher or PasswordHasher()
 
+    @timed('authenticate_admin')
     def authenticate_admin(self, username, password):
         """Authenticate admin users"""
         admin = self.db_session.query(Admin).filter_by(username=username).first()
-        if admin and verify_password(password, admin.password):
+        if admin and self.password_hasher.verify(password, admin.password):
             return generate_token(admin.id, is_admin=True)
         return None
 
+    @timed('authenticate_user')
     def authenticate_user(self, username, password):
         """Authenticate regular users"""
         user = self.db_session.query(User).filter_by(username=username).first()
-        if user and verify_password(password, user.password):
+        if user and self.password_hasher.verify(password, user.password):
             return generate_token(user.id, is_admin=False)
         return None
 
+    def update_user_password(self, user_id, new_password):
+        """Change a user's password and revoke their existing tokens"""
+        user = self.db_session.get(User, user_id)
+        if not user or not new_password:
+            return False
+
+        try:
+            user.password = self.password_hasher.hash(new_password)
+        except AuthOverloadedError:
+            return False
+        self.db_session.commit()
+
+        token_cache.invalidate_user(user_id, is_admin=False)
+        return True
+
     def create_admin(self, username, password, seniority):
         """Create a new admin account"""
         if self.db_session.query(Admin).filter_by(username=username).first():
             return False, "Username already exists"
         
+        try:
+            hashed = self.password_hasher.hash(password)
+        except AuthOverloadedError:
+            return False, "Server busy, please try again"
+
         new_admin = Admin(
             username=username,
-            password=hash_password(password),
+            password=hashed,
             seniority=seniority
         )
         self.db_session.add(new_admin)
@@ -93,9 +211,14 @@ class AuthManager:
         if self.db_session.query(User).filter_by(username=username).first():
             return False, "Username already exists"
         
+        try:
+            hashed = self.password_hasher.hash(password)
+        except AuthOverloadedError:
+            return False, "Server busy, please try again"
+
         new_user = User(
             username=username,
-            password=hash_password(password),
+            password=hashed,
             node_id=node_id
         )
         self.db_session.add(new_user)
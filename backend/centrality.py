@@ -0,0 +1,97 @@
+import networkx as nx
+from typing import Dict, Optional
+import threading
+
+class CentralityEngine:
+    """Whole-graph centrality metrics, computed once per graph version"""
+
+    def __init__(self, graph_manager, sample_threshold: int = 1000,
+                 sample_size: int = 256, background: bool = False):
+        self.graph_manager = graph_manager
+
+        # Above sample_threshold nodes, betweenness is approximated from
+        # sample_size pivot nodes instead of every node
+        self.sample_threshold = sample_threshold
+        self.sample_size = sample_size
+
+        # In background mode a stale snapshot is served while a worker
+        # thread computes the next one
+        self.background = background
+
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _compute(self, graph: nx.Graph, version: int) -> Dict:
+        """Compute degree, betweenness and closeness for every node"""
+        node_count = graph.number_of_nodes()
+        approximate = 0 < self.sample_size < node_count and node_count > self.sample_threshold
+
+        if approximate:
+            betweenness = nx.betweenness_centrality(graph, k=self.sample_size, seed=version)
+        else:
+            betweenness = nx.betweenness_centrality(graph)
+
+        return {
+            'version': version,
+            'approximate': approximate,
+            'degree': nx.degree_centrality(graph),
+            'betweenness': betweenness,
+            'closeness': nx.closeness_centrality(graph)
+        }
+
+    def _store(self, snapshot: Dict):
+        """Keep a snapshot unless a newer one is already stored"""
+        with self._lock:
+            if self._snapshot is None or snapshot['version'] >= self._snapshot['version']:
+                self._snapshot = snapshot
+
+    def refresh(self) -> Dict:
+        """Recompute centralities for the current graph synchronously"""
+        version = self.graph_manager.version
+        snapshot = self._compute(self.graph_manager.graph.copy(), version)
+        self._store(snapshot)
+        return snapshot
+
+    def _refresh_in_background(self):
+        """Start a worker recomputing centralities unless one is running"""
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            # Copy in the calling thread so the worker never iterates a
+            # graph that is being mutated
+            version = self.graph_manager.version
+            graph = self.graph_manager.graph.copy()
+            self._worker = threading.Thread(
+                target=lambda: self._store(self._compute(graph, version)),
+                name='centrality-refresh',
+                daemon=True
+            )
+            self._worker.start()
+
+    def get_snapshot(self) -> Dict:
+        """Get centralities for all nodes, recomputing if the graph changed"""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot['version'] == self.graph_manager.version:
+            return snapshot
+
+        if self.background and snapshot is not None:
+            self._refresh_in_background()
+            return snapshot
+
+        return self.refresh()
+
+    def get_node_centrality(self, node_id: int) -> Optional[Dict]:
+        """Get the centrality metrics of a single node"""
+        snapshot = self.get_snapshot()
+        if node_id not in snapshot['degree']:
+            return None
+        return {
+            'degree_centrality': snapshot['degree'][node_id],
+            'betweenness_centrality': snapshot['betweenness'][node_id],
+            'closeness_centrality': snapshot['closeness'][node_id]
+        }
+
+    def get_betweenness(self) -> Dict[int, float]:
+        """Get betweenness centrality for all nodes"""
+        return self.get_snapshot()['betweenness']
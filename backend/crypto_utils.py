@@ -1,18 +1,87 @@
 import datetime
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
 import base64
+import logging
 import os
+import threading
 import bcrypt
+from typing import List, Optional
+try:
+    from .metrics import timed
+except ImportError:
+    from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Envelope version bytes. A stored ciphertext starting with one of these
+# is [version][12-byte nonce][ciphertext + tag]; anything else is a
+# Fernet token, whose base64 text never starts with these bytes
+ENVELOPE_AES_GCM = 1
+ENVELOPE_CHACHA20 = 2
+AEAD_NONCE_SIZE = 12
+
+# MESSAGE_CIPHER setting -> envelope version (None writes Fernet tokens)
+MESSAGE_CIPHERS = {
+    'fernet': None,
+    'aes-gcm': ENVELOPE_AES_GCM,
+    'chacha20-poly1305': ENVELOPE_CHACHA20
+}
+
+def encode_ciphertext(data: bytes) -> str:
+    """Text form of a stored ciphertext, for JSON and templates"""
+    return base64.b64encode(data).decode()
+
+def decode_ciphertext(text: str) -> bytes:
+    """Stored form of a ciphertext received as text"""
+    return base64.b64decode(text)
 
 class CryptoManager:
-    def __init__(self):
-        # Generate a key for Fernet symmetric encryption
-        self.key = Fernet.generate_key()
-        self.cipher_suite = Fernet(self.key)
+    """Encrypt messages with a per-recipient key derived from a master secret
+
+    The master secret is stretched once with PBKDF2 into a root key, and
+    each recipient's keys are derived from that with HKDF, so every worker
+    and restart derives the same keys. New messages are sealed with the
+    configured cipher: an AEAD envelope (raw bytes, authenticated against
+    the recipient id) or a Fernet token. Both decrypt regardless of the
+    setting. Ready cipher objects are kept in an LRU cache of
+    key_cache_size entries.
+    """
+
+    # Fixed salts: derivation must be deterministic across processes
+    ROOT_KEY_SALT = b'scs-message-root-key'
+    RECIPIENT_KEY_SALT = b'scs-message-recipient-key'
+
+    def __init__(self, master_secret=None, key_cache_size: int = 1024,
+                 iterations: int = 100000, cipher: str = 'aes-gcm'):
+        if cipher not in MESSAGE_CIPHERS:
+            raise ValueError(f"Unknown message cipher: {cipher}")
+        self.envelope_version = MESSAGE_CIPHERS[cipher]
+
+        if master_secret is None:
+            # Without a configured secret nothing survives a restart
+            logger.warning("No encryption master secret configured; using a random per-process key")
+            master_secret = os.urandom(32)
+        if isinstance(master_secret, str):
+            master_secret = master_secret.encode()
+
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=self.ROOT_KEY_SALT,
+            iterations=iterations,
+        )
+        self._root_key = kdf.derive(master_secret)
+
+        self.key_cache_size = key_cache_size
+        self._ciphers = OrderedDict()
+        self._lock = threading.Lock()
         
     def generate_key_pair(self):
         """Generate a unique key pair for each user"""
@@ -26,65 +95,161 @@ class CryptoManager:
         key = base64.urlsafe_b64encode(os.urandom(32))
         return key, salt
 
-    def encrypt_message(self, message: str, recipient_key: bytes) -> bytes:
-        """Encrypt a message using recipient's public key"""
+    def derive_key(self, recipient_id: int, envelope_version: Optional[int] = None) -> bytes:
+        """Derive a recipient's 32-byte key for Fernet or an envelope version"""
+        info = f"recipient:{recipient_id}"
+        if envelope_version is not None:
+            info += f":v{envelope_version}"
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=self.RECIPIENT_KEY_SALT,
+            info=info.encode(),
+        )
+        return hkdf.derive(self._root_key)
+
+    def cipher_for(self, recipient_id: int, envelope_version: Optional[int] = None):
+        """Get the recipient's Fernet (or AEAD) object, deriving it on a cache miss"""
+        cache_key = (envelope_version, recipient_id)
+        with self._lock:
+            cipher = self._ciphers.get(cache_key)
+            if cipher is not None:
+                self._ciphers.move_to_end(cache_key)
+                return cipher
+
+        key = self.derive_key(recipient_id, envelope_version)
+        if envelope_version == ENVELOPE_AES_GCM:
+            cipher = AESGCM(key)
+        elif envelope_version == ENVELOPE_CHACHA20:
+            cipher = ChaCha20Poly1305(key)
+        else:
+            cipher = Fernet(base64.urlsafe_b64encode(key))
+
+        with self._lock:
+            self._ciphers[cache_key] = cipher
+            while len(self._ciphers) > self.key_cache_size:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+    def _seal(self, data: bytes, recipient_id: int) -> bytes:
+        version = self.envelope_version
+        if version is None:
+            return self.cipher_for(recipient_id).encrypt(data)
+        nonce = os.urandom(AEAD_NONCE_SIZE)
+        sealed = self.cipher_for(recipient_id, version).encrypt(
+            nonce, data, f"recipient:{recipient_id}".encode()
+        )
+        return bytes([version]) + nonce + sealed
+
+    @timed('encrypt_message')
+    def encrypt_message(self, message: str, recipient_id: int) -> bytes:
+        """Encrypt a message with the recipient's key"""
+        try:
+            return self._seal(message.encode(), recipient_id)
+        except Exception as e:
+            raise Exception(f"Encryption failed: {str(e)}")
+
+    @timed('encrypt_messages')
+    def encrypt_messages(self, message: str, recipient_ids: List[int]) -> List[bytes]:
+        """Encrypt one message for many recipients, encoding it once"""
         try:
-            # Convert message to bytes
-            message_bytes = message.encode()
-            
-            # Create a padder
-            padder = padding.PKCS7(128).padder()
-            padded_data = padder.update(message_bytes) + padder.finalize()
-            
-            # Encrypt using Fernet
-            encrypted_data = self.cipher_suite.encrypt(padded_data)
-            
-            return encrypted_data
-            
+            data = message.encode()
+            return [self._seal(data, recipient_id) for recipient_id in recipient_ids]
         except Exception as e:
             raise Exception(f"Encryption failed: {str(e)}")
 
-    def decrypt_message(self, encrypted_message: bytes, recipient_key: bytes) -> str:
-        """Decrypt a message using recipient's private key"""
+    @timed('decrypt_message')
+    def decrypt_message(self, encrypted_message: bytes, recipient_id: int) -> str:
+        """Decrypt an envelope or Fernet token with the recipient's key"""
         try:
-            # Decrypt using Fernet
-            decrypted_padded = self.cipher_suite.decrypt(encrypted_message)
-            
-            # Create an unpadder
-            unpadder = padding.PKCS7(128).unpadder()
-            data = unpadder.update(decrypted_padded) + unpadder.finalize()
-            
-            # Convert back to string
+            if isinstance(encrypted_message, str):
+                encrypted_message = encrypted_message.encode()
+            version = encrypted_message[0]
+            if version in (ENVELOPE_AES_GCM, ENVELOPE_CHACHA20):
+                nonce = encrypted_message[1:1 + AEAD_NONCE_SIZE]
+                data = self.cipher_for(recipient_id, version).decrypt(
+                    nonce, encrypted_message[1 + AEAD_NONCE_SIZE:], f"recipient:{recipient_id}".encode()
+                )
+            else:
+                data = self.cipher_for(recipient_id).decrypt(encrypted_message)
             return data.decode()
-            
         except Exception as e:
             raise Exception(f"Decryption failed: {str(e)}")
 
-def hash_password(password: str) -> str:
+def hash_password(password: str, rounds: int = 12) -> str:
     """Hash a password using bcrypt"""
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
 
 def verify_password(password: str, hashed: str) -> bool:
     """Verify a password against its hash"""
     return bcrypt.checkpw(password.encode(), hashed.encode())
 
+class AuthOverloadedError(Exception):
+    """Raised when the password hashing pool cannot take more work"""
+
+class PasswordHasher:
+    """Run bcrypt on a bounded worker pool instead of the request thread
+
+    bcrypt releases the GIL, so a thread pool runs hashes in parallel.
+    At most max_pending operations may be queued or running; beyond that,
+    requests fail fast with AuthOverloadedError instead of piling up.
+    """
+
+    def __init__(self, rounds: int = 12, max_workers: int = 4,
+                 max_pending: int = 32, timeout: float = 10.0):
+        self.rounds = rounds
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        """Run fn on the pool and wait for its result"""
+        if not self._slots.acquire(blocking=False):
+            raise AuthOverloadedError("Too many password operations in progress")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise AuthOverloadedError("Password operation timed out")
+
+    @timed('password_hash')
+    def hash(self, password: str) -> str:
+        """Hash a password with the configured cost factor"""
+        return self._run(hash_password, password, self.rounds)
+
+    @timed('password_verify')
+    def verify(self, password: str, hashed: str) -> bool:
+        """Verify a password against its hash"""
+        return self._run(verify_password, password, hashed)
+
+    def shutdown(self):
+        """Stop the worker threads once queued work is done"""
+        self._executor.shutdown(wait=True)
+
 class EncryptedMessage:
     def __init__(self, crypto_manager):
         self.crypto_manager = crypto_manager
     
     def prepare_message(self, sender_id: int, recipient_id: int, 
-                       message: str, recipient_key: bytes) -> dict:
+                       message: str) -> dict:
         """Prepare a message for sending"""
-        encrypted_content = self.crypto_manager.encrypt_message(message, recipient_key)
+        encrypted_content = self.crypto_manager.encrypt_message(message, recipient_id)
         
         return {
             'sender_id': sender_id,
             'recipient_id': recipient_id,
-            'content': base64.b64encode(encrypted_content).decode(),
+            'content': encode_ciphertext(encrypted_content),
             'timestamp': datetime.datetime.now().isoformat()
         }
     
-    def read_message(self, encrypted_message: dict, recipient_key: bytes) -> str:
+    def read_message(self, encrypted_message: dict) -> str:
         """Read an encrypted message"""
-        encrypted_content = base64.b64decode(encrypted_message['content'])
-        return self.crypto_manager.decrypt_message(encrypted_content, recipient_key)
\ No newline at end of file
+        encrypted_content = decode_ciphertext(encrypted_message['content'])
+        return self.crypto_manager.decrypt_message(encrypted_content, encrypted_message['recipient_id'])
\ No newline at end of file
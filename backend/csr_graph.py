@@ -0,0 +1,478 @@
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import func, select
+from database import User, NetworkEdge, GraphChange
+from graph_utils import NetworkGraph
+from network_stats import sweep_diameter_bounds
+try:
+    from .metrics import timed
+except ImportError:
+    from metrics import timed
+import threading
+
+# Overlay marker for a node or edge removed since the last compaction
+_REMOVED = object()
+
+# Weight of an edge added without one
+DEFAULT_WEIGHT = 1
+
+def _mirror_change(graph: nx.Graph, op: str, node1_id: int, node2_id: Optional[int],
+                   weight: Optional[int], username: Optional[str]):
+    """Apply a mutation to a networkx copy the way the arrays record it"""
+    if op == 'add_node':
+        graph.add_node(node1_id, username=username)
+    elif op == 'remove_node':
+        if node1_id in graph:
+            graph.remove_node(node1_id)
+    elif op == 'add_edge':
+        for node in (node1_id, node2_id):
+            if node not in graph:
+                graph.add_node(node, username=None)
+        graph.add_edge(node1_id, node2_id, weight=DEFAULT_WEIGHT if weight is None else weight)
+    elif op == 'remove_edge':
+        if graph.has_edge(node1_id, node2_id):
+            graph.remove_edge(node1_id, node2_id)
+
+class CSRNetworkGraph(NetworkGraph):
+    """NetworkGraph storing its topology as a CSR adjacency matrix
+
+    Node ids are kept sorted in node_ids and a node's position there is its
+    row in adjacency; every undirected edge is stored in both rows with a
+    float64 weight, so SciPy's csgraph routines use the arrays as they are.
+    Mutations collect in a small overlay that is folded into new arrays on
+    the next read, which suits large, mostly static topologies. Features
+    that need networkx (centrality, layout, path enumeration, relaying) get
+    a graph built from the arrays on first use; once built, mutations are
+    applied to it as well, so it is never rebuilt for a single change.
+    """
+
+    def __init__(self, db_session, **kwargs):
+        self.node_ids = np.empty(0, dtype=np.int64)
+        self.usernames = np.empty(0, dtype=object)
+        self.adjacency = sparse.csr_matrix((0, 0), dtype=np.float64)
+
+        # Pending mutations: final username (or _REMOVED) per node, weight
+        # (or _REMOVED) per (low id, high id) pair, and nodes whose stored
+        # edges were dropped by a removal
+        self._node_overlay = {}
+        self._edge_overlay = {}
+        self._dropped_nodes = set()
+        self._compact_lock = threading.RLock()
+        self._nx_cache = (None, None)
+        self._components_cache = (None, None)
+
+        super().__init__(db_session, **kwargs)
+
+    @property
+    def graph(self) -> nx.Graph:
+        """A networkx copy of the topology, for the features that need one"""
+        version, graph = self._nx_cache
+        if version == self.version:
+            return graph
+
+        with self._compact_lock:
+            self._compact()
+            version = self.version
+            graph = nx.Graph()
+            graph.add_nodes_from((node, {'username': username}) for node, username
+                                 in zip(self.node_ids.tolist(), self.usernames))
+            edges = sparse.triu(self.adjacency, format='coo')
+            graph.add_weighted_edges_from(zip(self.node_ids[edges.row].tolist(),
+                                              self.node_ids[edges.col].tolist(),
+                                              edges.data.astype(np.int64).tolist()))
+            self._nx_cache = (version, graph)
+        return graph
+
+    @graph.setter
+    def graph(self, value):
+        # NetworkGraph.__init__ starts from an empty graph; the topology
+        # itself only ever lives in the arrays
+        if value.number_of_nodes():
+            raise ValueError("CSRNetworkGraph topology can't be assigned a networkx graph")
+
+    def load_graph(self):
+        """Load the network graph from database into arrays"""
+        if self.db_session is None:
+            self._topology_changed()
+            return
+
+        self.log_version = self.db_session.query(func.max(GraphChange.id)).scalar() or 0
+
+        users = self.db_session.execute(
+            select(User.node_id, User.username).where(User.node_id.isnot(None))
+        ).all()
+        node_ids = np.array([user.node_id for user in users], dtype=np.int64)
+        usernames = [user.username for user in users]
+
+        # Stream edges in chunks so only one chunk of row objects exists at a time
+        chunks = [np.empty((0, 3), dtype=np.int64)]
+        result = self.db_session.execute(
+            select(NetworkEdge.node1_id, NetworkEdge.node2_id, func.coalesce(NetworkEdge.weight, 1))
+            .execution_options(yield_per=50000)
+        )
+        for partition in result.partitions():
+            chunks.append(np.array(partition, dtype=np.int64).reshape(-1, 3))
+        edges = np.concatenate(chunks)
+
+        with self._compact_lock:
+            self._build(node_ids, usernames, edges[:, 0], edges[:, 1], edges[:, 2])
+        self._topology_changed()
+
+    def _build(self, node_ids: np.ndarray, usernames: List, u: np.ndarray,
+               v: np.ndarray, weights: np.ndarray):
+        """Replace the arrays with the given node list and edge list"""
+        # Edge endpoints without a user row still become (nameless) nodes
+        ids = np.union1d(node_ids, np.concatenate([u, v])).astype(np.int64)
+        names = np.full(len(ids), None, dtype=object)
+        if len(node_ids):
+            names[np.searchsorted(ids, node_ids)] = usernames
+
+        n = len(ids)
+        rows = np.searchsorted(ids, u)
+        cols = np.searchsorted(ids, v)
+        low = np.minimum(rows, cols)
+        high = np.maximum(rows, cols)
+
+        # Keep the last weight given for a pair, as repeated add_edge calls do
+        keys = low.astype(np.int64) * n + high
+        _, last = np.unique(keys[::-1], return_index=True)
+        keep = len(keys) - 1 - last
+        low, high, weights = low[keep], high[keep], np.asarray(weights, dtype=np.float64)[keep]
+
+        # Mirror every edge except self-loops into the other endpoint's row
+        mirror = low != high
+        adjacency = sparse.csr_matrix(
+            (np.concatenate([weights, weights[mirror]]),
+             (np.concatenate([low, high[mirror]]), np.concatenate([high, low[mirror]]))),
+            shape=(n, n)
+        )
+
+        self.node_ids = ids
+        self.usernames = names
+        self.adjacency = adjacency
+
+    def _compact(self):
+        """Fold the pending mutations into new arrays"""
+        with self._compact_lock:
+            if not self._node_overlay and not self._edge_overlay:
+                return
+
+            ids = self.node_ids
+            n = len(ids)
+            edges = sparse.triu(self.adjacency, format='coo')
+            keep = np.ones(edges.nnz, dtype=bool)
+
+            # Stored edges of removed nodes are gone
+            if self._dropped_nodes:
+                dropped = np.fromiter(self._dropped_nodes, dtype=np.int64)
+                keep &= ~np.isin(ids[edges.row], dropped) & ~np.isin(ids[edges.col], dropped)
+
+            # Stored edges the overlay replaces or removes are gone too
+            overlay_keys = []
+            for low, high in self._edge_overlay:
+                i, j = self._index(low), self._index(high)
+                if i is not None and j is not None:
+                    overlay_keys.append(i * n + j)
+            if overlay_keys:
+                keys = edges.row.astype(np.int64) * n + edges.col
+                keep &= ~np.isin(keys, np.array(overlay_keys, dtype=np.int64))
+
+            # Unweighted edges weigh 1, as they do when loaded from the database
+            added = [(low, high, DEFAULT_WEIGHT if weight is None else weight)
+                     for (low, high), weight in self._edge_overlay.items()
+                     if weight is not _REMOVED]
+            added = np.array(added, dtype=np.int64).reshape(-1, 3)
+            u = np.concatenate([ids[edges.row[keep]], added[:, 0]])
+            v = np.concatenate([ids[edges.col[keep]], added[:, 1]])
+            weights = np.concatenate([edges.data[keep], added[:, 2]])
+
+            changed = np.fromiter(self._node_overlay, dtype=np.int64, count=len(self._node_overlay))
+            unchanged = ~np.isin(ids, changed)
+            present = [(node, username) for node, username in self._node_overlay.items()
+                       if username is not _REMOVED]
+            node_ids = np.concatenate([ids[unchanged],
+                                       np.array([node for node, _ in present], dtype=np.int64)])
+            usernames = list(self.usernames[unchanged]) + [username for _, username in present]
+
+            self._build(node_ids, usernames, u, v, weights)
+            self._node_overlay.clear()
+            self._edge_overlay.clear()
+            self._dropped_nodes.clear()
+
+    def _index(self, node_id) -> Optional[int]:
+        """Row of a node in the stored arrays, or None"""
+        i = int(np.searchsorted(self.node_ids, node_id))
+        if i < len(self.node_ids) and self.node_ids[i] == node_id:
+            return i
+        return None
+
+    def _has_node(self, node_id) -> bool:
+        if node_id in self._node_overlay:
+            return self._node_overlay[node_id] is not _REMOVED
+        return self._index(node_id) is not None
+
+    def _has_edge(self, node1_id, node2_id) -> bool:
+        pair = NetworkEdge.canonical_pair(node1_id, node2_id)
+        if pair in self._edge_overlay:
+            return self._edge_overlay[pair] is not _REMOVED
+        if node1_id in self._dropped_nodes or node2_id in self._dropped_nodes:
+            return False
+        i, j = self._index(node1_id), self._index(node2_id)
+        if i is None or j is None:
+            return False
+        row = self.adjacency.indices[self.adjacency.indptr[i]:self.adjacency.indptr[i + 1]]
+        return bool(np.any(row == j))
+
+    def _clear_graph(self):
+        """Drop every node and edge"""
+        with self._compact_lock:
+            self._nx_cache = (None, None)
+            self._node_overlay.clear()
+            self._edge_overlay.clear()
+            self._dropped_nodes.clear()
+            self._build(np.empty(0, dtype=np.int64), [], np.empty(0, dtype=np.int64),
+                        np.empty(0, dtype=np.int64), np.empty(0))
+
+    def _apply_change(self, op: str, node1_id: int, node2_id: Optional[int] = None,
+                      weight: Optional[int] = None, username: Optional[str] = None,
+                      strict: bool = False):
+        """Record one mutation in the overlay; see NetworkGraph._apply_change"""
+        with self._compact_lock:
+            # A networkx copy that is current now is kept current below
+            cached_version, cached = self._nx_cache
+            if cached is None or cached_version != self.version:
+                cached = None
+            self._record_overlay(op, node1_id, node2_id, weight, username, strict)
+            if cached is not None:
+                _mirror_change(cached, op, node1_id, node2_id, weight, username)
+                self._nx_cache = (self.version, cached)
+
+    def _apply_synced(self, changes: List[Dict]):
+        """Record logged changes in the overlay
+
+        The arrays are replaced rather than edited on compaction, but a
+        current networkx copy may be in a reader's hands, so the changes are
+        mirrored into a copy of it that then takes its place.
+        """
+        with self._compact_lock:
+            cached_version, cached = self._nx_cache
+            cached = cached.copy() if cached is not None and cached_version == self.version else None
+            for change in changes:
+                self._record_overlay(change['op'], change['node1_id'], change['node2_id'],
+                                     change['weight'], change['username'], False)
+                if cached is not None:
+                    _mirror_change(cached, change['op'], change['node1_id'], change['node2_id'],
+                                   change['weight'], change['username'])
+            self._nx_cache = (self.version, cached) if cached is not None else (None, None)
+            self.log_version = changes[-1]['version']
+
+    def _reload_graph(self):
+        """Rebuild the arrays from the database; readers wait for the new ones"""
+        with self._compact_lock:
+            self._clear_graph()
+            self.load_graph()
+
+    def _record_overlay(self, op: str, node1_id: int, node2_id: Optional[int],
+                        weight: Optional[int], username: Optional[str], strict: bool):
+        with self._compact_lock:
+            if op == 'add_node':
+                self._node_overlay[node1_id] = username
+                self._topology_changed(node1_id)
+            elif op == 'remove_node':
+                if not self._has_node(node1_id):
+                    if strict:
+                        raise nx.NetworkXError(f"The node {node1_id} is not in the graph.")
+                    return
+                self._node_overlay[node1_id] = _REMOVED
+                self._dropped_nodes.add(node1_id)
+                for pair in [pair for pair in self._edge_overlay if node1_id in pair]:
+                    del self._edge_overlay[pair]
+                self._layout.pop(node1_id, None)
+                self._topology_changed(node1_id)
+            elif op == 'add_edge':
+                for node in (node1_id, node2_id):
+                    if not self._has_node(node):
+                        self._node_overlay[node] = None
+                self._edge_overlay[NetworkEdge.canonical_pair(node1_id, node2_id)] = weight
+                self._topology_changed(node1_id, node2_id)
+            elif op == 'remove_edge':
+                if not self._has_edge(node1_id, node2_id):
+                    if strict:
+                        raise nx.NetworkXError(f"The edge {node1_id}-{node2_id} is not in the graph")
+                    return
+                self._edge_overlay[NetworkEdge.canonical_pair(node1_id, node2_id)] = _REMOVED
+                self._topology_changed(node1_id, node2_id)
+            else:
+                raise ValueError(f"Unknown graph change: {op}")
+
+    def iter_nodes(self) -> Iterator[Tuple[int, Optional[str]]]:
+        """Yield (node id, username) for every node, from the current arrays"""
+        node_ids, usernames, _ = self._snapshot()
+        for start in range(0, len(node_ids), 10000):
+            yield from zip(node_ids[start:start + 10000].tolist(), usernames[start:start + 10000])
+
+    def iter_edges(self) -> Iterator[Tuple[int, int, int]]:
+        """Yield (node1 id, node2 id, weight) for every edge, from the current arrays"""
+        node_ids, _, adjacency = self._snapshot()
+        edges = sparse.triu(adjacency, format='coo')
+        for start in range(0, edges.nnz, 10000):
+            end = start + 10000
+            yield from zip(node_ids[edges.row[start:end]].tolist(),
+                           node_ids[edges.col[start:end]].tolist(),
+                           edges.data[start:end].astype(np.int64).tolist())
+
+    def _snapshot(self) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+        """Compacted arrays; later mutations replace them rather than edit them"""
+        with self._compact_lock:
+            self._compact()
+            return self.node_ids, self.usernames, self.adjacency
+
+    def _predecessors(self, source_id: int, cache: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """Node ids and the Dijkstra predecessor array for a source node
+
+        Predecessor arrays take the place of path trees in the route cache.
+        """
+        with self._route_lock:
+            entry = self._route_cache.get(source_id)
+            if entry is not None:
+                self._route_cache.move_to_end(source_id)
+                return entry
+            version = self.version
+
+        node_ids, _, adjacency = self._snapshot()
+        i = int(np.searchsorted(node_ids, source_id))
+        if i >= len(node_ids) or node_ids[i] != source_id:
+            raise nx.NodeNotFound(f"Source {source_id} is not in G")
+
+        # The matrix is symmetric, so the directed search is the undirected one
+        _, predecessors = csgraph.dijkstra(adjacency, directed=True, indices=i,
+                                           return_predecessors=True)
+        entry = (node_ids, predecessors)
+
+        with self._route_lock:
+            if cache and version == self.version and self.route_cache_size > 0:
+                self._route_cache[source_id] = entry
+                while len(self._route_cache) > self.route_cache_size:
+                    self._route_cache.popitem(last=False)
+        return entry
+
+    @timed('get_shortest_path')
+    def get_shortest_path(self, source_id: int, target_id: int,
+                          build_tree: bool = True) -> List[int]:
+        """Find the shortest path between two nodes using SciPy's Dijkstra
+
+        With build_tree=False the predecessor array isn't cached.
+        """
+        node_ids, predecessors = self._predecessors(source_id, cache=build_tree)
+        j = int(np.searchsorted(node_ids, target_id))
+        if j >= len(node_ids) or node_ids[j] != target_id:
+            return None
+
+        i = int(np.searchsorted(node_ids, source_id))
+        path = [j]
+        while path[-1] != i:
+            previous = predecessors[path[-1]]
+            if previous < 0:
+                return None
+            path.append(previous)
+        return node_ids[path[::-1]].tolist()
+
+    def get_shortest_path_tree(self, source_id: int) -> Dict[int, List[int]]:
+        """Get the shortest paths from a node to every reachable node
+
+        This materializes every path; prefer get_shortest_path for lookups.
+        """
+        node_ids, predecessors = self._predecessors(source_id)
+        i = int(np.searchsorted(node_ids, source_id))
+        paths = {i: [i]}
+
+        def path_to(j):
+            # Walk up to the nearest node with a known path, then fill back down
+            chain = []
+            while j not in paths:
+                chain.append(j)
+                j = predecessors[j]
+            for node in reversed(chain):
+                paths[node] = paths[j] + [node]
+                j = node
+
+        for j in np.flatnonzero(predecessors >= 0).tolist():
+            path_to(j)
+        return {int(node_ids[j]): node_ids[path].tolist() for j, path in paths.items()}
+
+    def precompute_routes(self, source_ids: Optional[Iterable[int]] = None):
+        """Warm the route cache with predecessor arrays for the given nodes"""
+        node_ids, _, _ = self._snapshot()
+        if source_ids is None:
+            source_ids = node_ids.tolist()
+        for source_id in source_ids:
+            if self._index(source_id) is not None:
+                self._predecessors(source_id)
+
+    def get_node_connections(self, node_id: int) -> List[Tuple[int, str]]:
+        """Get all nodes connected to a given node"""
+        node_ids, usernames, adjacency = self._snapshot()
+        i = int(np.searchsorted(node_ids, node_id))
+        if i >= len(node_ids) or node_ids[i] != node_id:
+            return []
+        neighbors = adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i + 1]]
+        return [(int(node_ids[j]), usernames[j]) for j in neighbors]
+
+    def get_network_status(self) -> Dict:
+        """Get overall network statistics
+
+        Counts come straight from the arrays; see NetworkGraph for the
+        diameter and diameter_exact fields.
+        """
+        node_ids, _, adjacency = self._snapshot()
+        node_count = len(node_ids)
+        self_loops = int(np.count_nonzero(adjacency.diagonal()))
+        edge_count = (adjacency.nnz + self_loops) // 2
+
+        components = 0
+        if node_count:
+            version, components = self._components_cache
+            if version != self.version:
+                version = self.version
+                components, _ = csgraph.connected_components(adjacency, directed=False)
+                self._components_cache = (version, components)
+        diameter, exact = self._get_diameter(components == 1)
+
+        return {
+            'total_nodes': node_count,
+            'total_edges': edge_count,
+            'average_degree': 2 * edge_count / node_count if node_count > 0 else 0,
+            'diameter': diameter,
+            'diameter_exact': exact,
+            'density': 2 * edge_count / (node_count * (node_count - 1)) if node_count > 1 else 0,
+            'is_connected': components == 1,
+            'components': components
+        }
+
+    def _get_diameter(self, is_connected: bool) -> Tuple[float, bool]:
+        """Diameter and whether it is exact, computed once per graph version"""
+        version, diameter, exact = self._diameter_cache
+        if version == self.version:
+            return diameter, exact
+
+        version = self.version
+        node_ids, _, adjacency = self._snapshot()
+        if not is_connected:
+            diameter, exact = float('inf'), True
+        elif len(node_ids) <= self.diameter_exact_limit:
+            hops = csgraph.shortest_path(adjacency, directed=False, unweighted=True)
+            diameter, exact = int(hops.max()), True
+        else:
+            def eccentricity(i):
+                hops = csgraph.shortest_path(adjacency, directed=False, unweighted=True, indices=i)
+                farthest = int(np.argmax(hops))
+                return int(hops[farthest]), farthest
+
+            lower, upper = sweep_diameter_bounds(eccentricity, 0, self.diameter_sweeps)
+            diameter, exact = lower, lower == upper
+
+        self._diameter_cache = (version, diameter, exact)
+        return diameter, exact
@@ -1,7 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import create_engine, event, inspect, Column, Integer, String, Boolean, ForeignKey, DateTime, Index, LargeBinary, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.pool import StaticPool
 import datetime
+import os
+import threading
+try:
+    from .metrics import instrument_engine
+except ImportError:
+    from metrics import instrument_engine
+
+DEFAULT_DATABASE_URI = 'sqlite:///secure_comm.db'
 
 # Create the base class for declarative models
 Base = declarative_base()
@@ -33,7 +42,7 @@ class Message(Base):
     id = Column(Integer, primary_key=True)
     sender_id = Column(Integer, ForeignKey('users.id'))
     receiver_id = Column(Integer, ForeignKey('users.id'))
-    encrypted_content = Column(String(1000))
+    encrypted_content = Column(LargeBinary)  # Raw envelope bytes (or a legacy Fernet token)
     sent_at = Column(DateTime, default=datetime.datetime.utcnow)
     read = Column(Boolean, default=False)
     
@@ -41,6 +50,25 @@ class Message(Base):
     sender = relationship("User", foreign_keys=[sender_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
 
+    # Indexes match the MessageHandler query shapes: conversations and sent
+    # counts lead with sender_id, unread/received reads with receiver_id,
+    # and all of them end in the (sent_at, id) pagination key
+    __table_args__ = (
+        Index('ix_messages_sender_receiver_sent', 'sender_id', 'receiver_id', 'sent_at', 'id'),
+        Index('ix_messages_receiver_read_sent', 'receiver_id', 'read', 'sent_at', 'id'),
+        Index('ix_messages_sent_at', 'sent_at'),
+    )
+
+# Define the UserMessageStats model: per-user message counters kept in step
+# with the messages table so the dashboard never has to count rows
+class UserMessageStats(Base):
+    __tablename__ = 'user_message_stats'
+    
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    sent_count = Column(Integer, nullable=False, default=0)
+    received_count = Column(Integer, nullable=False, default=0)
+    unread_count = Column(Integer, nullable=False, default=0)
+
 # Define the NetworkEdge model for graph connections
 class NetworkEdge(Base):
     __tablename__ = 'network_edges'
@@ -50,15 +78,195 @@ class NetworkEdge(Base):
     node2_id = Column(Integer, ForeignKey('users.id'))
     weight = Column(Integer, default=1)  # For shortest path calculations
 
-# Database initialization function
-def init_db():
-    # Use SQLite for simplicity
-    engine = create_engine('sqlite:///secure_comm.db')
-    Base.metadata.create_all(engine)
+    # Edges are stored once, as (lower node id, higher node id)
+    __table_args__ = (
+        Index('ix_network_edges_pair', 'node1_id', 'node2_id', unique=True),
+        Index('ix_network_edges_node2', 'node2_id'),
+    )
+
+    @staticmethod
+    def canonical_pair(node1_id: int, node2_id: int):
+        """Order an undirected edge's endpoints the way they are stored"""
+        return (node1_id, node2_id) if node1_id <= node2_id else (node2_id, node1_id)
+
+# Define the GraphChange model: an append-only log of topology mutations,
+# whose ids double as graph versions for workers and clients
+class GraphChange(Base):
+    __tablename__ = 'graph_changes'
     
-    # Create session maker
-    Session = sessionmaker(bind=engine)
-    return Session()
+    id = Column(Integer, primary_key=True)
+    op = Column(String(20), nullable=False)  # add_node, remove_node, add_edge, remove_edge
+    node1_id = Column(Integer, nullable=False)
+    node2_id = Column(Integer)
+    weight = Column(Integer)
+    username = Column(String(50))
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'version': self.id,
+            'op': self.op,
+            'node1_id': self.node1_id,
+            'node2_id': self.node2_id,
+            'weight': self.weight,
+            'username': self.username
+        }
+
+# One engine and session registry per process, plus a read-only pair
+# for history and dashboard queries (the same engine unless SQLite-backed)
+engine = None
+db_session = None
+read_engine = None
+read_session = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+SQLITE_JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+SQLITE_SYNCHRONOUS_LEVELS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+
+def _is_memory_sqlite(uri: str) -> bool:
+    return uri in ('sqlite://', 'sqlite:///:memory:')
+
+def sqlite_pragmas(config=None, read_only: bool = False):
+    """Build the PRAGMA statements for the configured SQLite profile"""
+    config = config or {}
+    pragmas = []
+
+    journal_mode = config.get('SQLITE_JOURNAL_MODE')
+    if journal_mode:
+        if journal_mode.upper() not in SQLITE_JOURNAL_MODES:
+            raise ValueError(f"Invalid SQLITE_JOURNAL_MODE: {journal_mode}")
+        pragmas.append(f"PRAGMA journal_mode={journal_mode.upper()}")
+
+    synchronous = config.get('SQLITE_SYNCHRONOUS')
+    if synchronous:
+        if synchronous.upper() not in SQLITE_SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Invalid SQLITE_SYNCHRONOUS: {synchronous}")
+        pragmas.append(f"PRAGMA synchronous={synchronous.upper()}")
+
+    for setting, pragma in (('SQLITE_CACHE_SIZE', 'cache_size'),
+                            ('SQLITE_MMAP_SIZE', 'mmap_size'),
+                            ('SQLITE_BUSY_TIMEOUT', 'busy_timeout')):
+        value = config.get(setting)
+        if value is not None:
+            pragmas.append(f"PRAGMA {pragma}={int(value)}")
+
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+    return pragmas
+
+def create_db_engine(config=None, read_only: bool = False):
+    """Create an engine with a connection pool sized from the configuration"""
+    config = config or {}
+    uri = config.get('SQLALCHEMY_DATABASE_URI') or DEFAULT_DATABASE_URI
+    pool_size = config.get('SQLALCHEMY_POOL_SIZE', 5)
+
+    if uri.startswith('sqlite'):
+        connect_args = {'check_same_thread': False}
+        if _is_memory_sqlite(uri):
+            # An in-memory database only exists on one connection, so share it
+            return create_engine(uri, connect_args=connect_args, poolclass=StaticPool)
+        if read_only:
+            pool_size = config.get('SQLITE_READ_POOL_SIZE', pool_size)
+    else:
+        connect_args = {}
+
+    db_engine = create_engine(
+        uri,
+        connect_args=connect_args,
+        pool_size=pool_size,
+        max_overflow=config.get('SQLALCHEMY_MAX_OVERFLOW', 10),
+        pool_timeout=config.get('SQLALCHEMY_POOL_TIMEOUT', 30),
+        pool_recycle=config.get('SQLALCHEMY_POOL_RECYCLE', 1800),
+        pool_pre_ping=True
+    )
+
+    if uri.startswith('sqlite'):
+        pragmas = sqlite_pragmas(config, read_only=read_only)
+
+        @event.listens_for(db_engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+    return db_engine
+
+# Database initialization function
+def init_db(config=None):
+    """Initialize the process-wide engine and return the scoped session registry
+
+    Calling this again in the same process returns the existing registry.
+    Each thread (or request) gets its own session from the registry; call
+    remove_session when the request ends. A file-backed SQLite database also
+    gets a separate read-only pool, exposed as read_session.
+    """
+    global engine, db_session, read_engine, read_session, _engine_pid
+
+    with _engine_lock:
+        if engine is not None and _engine_pid == os.getpid():
+            return db_session
+
+        if engine is not None:
+            # Forked worker: don't reuse the parent's pooled connections
+            engine.dispose(close=False)
+            if read_engine is not engine:
+                read_engine.dispose(close=False)
+
+        config = config or {}
+        engine = create_db_engine(config)
+        instrument_engine(engine)
+        _engine_pid = os.getpid()
+        Base.metadata.create_all(engine)
+        migrate_db(engine)
+
+        uri = config.get('SQLALCHEMY_DATABASE_URI') or DEFAULT_DATABASE_URI
+        if uri.startswith('sqlite') and not _is_memory_sqlite(uri) and config.get('SQLITE_READ_POOL', True):
+            # With WAL journaling these readers never block the writer
+            read_engine = create_db_engine(config, read_only=True)
+            instrument_engine(read_engine)
+        else:
+            read_engine = engine
+
+        # Create thread-local session registries
+        db_session = scoped_session(sessionmaker(bind=engine))
+        read_session = scoped_session(sessionmaker(bind=read_engine))
+        return db_session
+
+def migrate_db(engine):
+    """Bring a database created by an older version up to the current schema
+
+    create_all only creates missing tables, so existing files also need
+    their edges canonicalized and deduplicated, and the newer indexes added.
+    Every step is a no-op on an up-to-date database.
+    """
+    edge_indexes = {index['name'] for index in inspect(engine).get_indexes('network_edges')}
+    if 'ix_network_edges_pair' not in edge_indexes:
+        with engine.begin() as conn:
+            # Keep the oldest row of each undirected edge
+            conn.execute(text(
+                "DELETE FROM network_edges WHERE id NOT IN ("
+                " SELECT MIN(id) FROM network_edges GROUP BY"
+                " CASE WHEN node1_id < node2_id THEN node1_id ELSE node2_id END,"
+                " CASE WHEN node1_id < node2_id THEN node2_id ELSE node1_id END)"
+            ))
+            # Store every edge as (lower id, higher id)
+            conn.execute(text(
+                "UPDATE network_edges SET node1_id = node2_id, node2_id = node1_id"
+                " WHERE node1_id > node2_id"
+            ))
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def remove_session(exception=None):
+    """Close the current thread's sessions and return their connections to the pools"""
+    if db_session is not None:
+        db_session.remove()
+    if read_session is not None:
+        read_session.remove()
 
 # Create initial admin and users
 def create_initial_data(session):
@@ -0,0 +1,202 @@
+from typing import Dict, Iterator, Optional
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+import csv
+import io
+import json
+
+# Format name -> (content type, file extension)
+GRAPH_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'json': ('application/json', 'json'),
+    'graphml': ('application/graphml+xml', 'graphml')
+}
+
+CSV_COLUMNS = ('node1_id', 'node2_id', 'weight')
+GRAPHML_NS = 'http://graphml.graphdrawing.org/xmlns'
+
+# Rows or entries serialized per chunk of an export
+EXPORT_CHUNK = 1000
+
+def format_for(filename: Optional[str]) -> Optional[str]:
+    """Guess the graph format from a file name's extension"""
+    if not filename or '.' not in filename:
+        return None
+    extension = filename.rsplit('.', 1)[1].lower()
+    for name, (_, format_extension) in GRAPH_FORMATS.items():
+        if extension == format_extension:
+            return name
+    return None
+
+def read_graph(stream, graph_format: str) -> Iterator[Dict]:
+    """Parse an uploaded topology into add_node/add_edge changes
+
+    stream is a binary file object. CSV files hold one edge per row
+    (node1_id, node2_id and an optional weight, with an optional header);
+    JSON holds either a list of edges or an object with 'nodes' and
+    'links' (or 'edges'), as exported; GraphML is read incrementally.
+    Malformed input raises ValueError.
+    """
+    if graph_format == 'csv':
+        return _parse_errors(_read_csv(io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')))
+    if graph_format == 'json':
+        return _parse_errors(_read_json(stream))
+    if graph_format == 'graphml':
+        return _parse_errors(_read_graphml(stream))
+    raise ValueError(f"Unsupported graph format: {graph_format}")
+
+def _parse_errors(changes: Iterator[Dict]) -> Iterator[Dict]:
+    """Re-raise the parsers' own exceptions as ValueError"""
+    try:
+        yield from changes
+    except (csv.Error, ET.ParseError) as e:
+        raise ValueError(f"Malformed graph file: {e}")
+
+def _edge(node1, node2, weight=None) -> Dict:
+    return {'op': 'add_edge', 'node1_id': node1, 'node2_id': node2, 'weight': weight}
+
+def _read_csv(text) -> Iterator[Dict]:
+    reader = csv.reader(text)
+    columns = None
+    for line_number, row in enumerate(reader, 1):
+        if not row or not ''.join(row).strip():
+            continue
+        if line_number == 1 and not row[0].strip().lstrip('-').isdigit():
+            # Header row; map the known column names to positions
+            names = [name.strip().lower() for name in row]
+            aliases = {'source': 'node1_id', 'target': 'node2_id'}
+            names = [aliases.get(name, name) for name in names]
+            try:
+                columns = [names.index('node1_id'), names.index('node2_id')]
+            except ValueError:
+                raise ValueError("CSV header needs node1_id and node2_id (or source and target) columns")
+            columns.append(names.index('weight') if 'weight' in names else None)
+            continue
+
+        node1, node2, weight = columns or (0, 1, 2 if len(row) > 2 else None)
+        try:
+            yield _edge(row[node1], row[node2],
+                        row[weight] if weight is not None and weight < len(row) else None)
+        except IndexError:
+            raise ValueError(f"CSV line {line_number} has too few columns")
+
+def _read_json(stream) -> Iterator[Dict]:
+    try:
+        data = json.load(stream)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+
+    if isinstance(data, list):
+        nodes, links = [], data
+    elif isinstance(data, dict):
+        nodes = data.get('nodes', [])
+        links = data.get('links', data.get('edges', []))
+    else:
+        raise ValueError("JSON graph must be a list of edges or an object with nodes and links")
+
+    for node in nodes:
+        if not isinstance(node, dict) or 'id' not in node:
+            raise ValueError(f"Invalid JSON node: {node}")
+        yield {'op': 'add_node', 'node1_id': node['id'], 'username': node.get('username')}
+    for link in links:
+        if isinstance(link, dict):
+            yield _edge(link.get('source', link.get('node1_id')),
+                        link.get('target', link.get('node2_id')),
+                        link.get('weight'))
+        elif isinstance(link, (list, tuple)) and len(link) in (2, 3):
+            yield _edge(*link)
+        else:
+            raise ValueError(f"Invalid JSON edge: {link}")
+
+def _read_graphml(stream) -> Iterator[Dict]:
+    keys = {}
+    try:
+        for _, element in ET.iterparse(stream, events=('end',)):
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'key':
+                keys[element.get('id')] = element.get('attr.name')
+            elif tag == 'node':
+                data = _graphml_data(element, keys)
+                yield {'op': 'add_node', 'node1_id': element.get('id'),
+                       'username': data.get('username')}
+                element.clear()
+            elif tag == 'edge':
+                data = _graphml_data(element, keys)
+                yield _edge(element.get('source'), element.get('target'), data.get('weight'))
+                element.clear()
+    except ET.ParseError as e:
+        raise ValueError(f"Invalid GraphML: {e}")
+
+def _graphml_data(element, keys: Dict) -> Dict:
+    return {keys.get(data.get('key'), data.get('key')): data.text
+            for data in element if data.tag.rsplit('}', 1)[-1] == 'data'}
+
+def write_graph(graph_manager, graph_format: str) -> Iterator[str]:
+    """Serialize the current topology in chunks, for streaming responses
+
+    Nodes and edges come from graph_manager.iter_nodes/iter_edges, so the
+    whole document is never built in memory.
+    """
+    if graph_format == 'csv':
+        return _write_csv(graph_manager)
+    if graph_format == 'json':
+        return _write_json(graph_manager)
+    if graph_format == 'graphml':
+        return _write_graphml(graph_manager)
+    raise ValueError(f"Unsupported graph format: {graph_format}")
+
+def _batched(rows, size: int = EXPORT_CHUNK) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _write_csv(graph_manager) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    for batch in _batched(graph_manager.iter_edges()):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def _write_json(graph_manager) -> Iterator[str]:
+    # Same shape as /api/network-data, so an export can be imported again
+    yield '{"nodes": ['
+    separator = ''
+    for batch in _batched(graph_manager.iter_nodes()):
+        yield separator + ', '.join(json.dumps({'id': node, 'username': username})
+                                    for node, username in batch)
+        separator = ', '
+    yield '], "links": ['
+    separator = ''
+    for batch in _batched(graph_manager.iter_edges()):
+        yield separator + ', '.join(json.dumps({'source': u, 'target': v, 'weight': weight})
+                                    for u, v, weight in batch)
+        separator = ', '
+    yield ']}\n'
+
+def _write_graphml(graph_manager) -> Iterator[str]:
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<graphml xmlns="{GRAPHML_NS}">\n'
+           '  <key id="username" for="node" attr.name="username" attr.type="string"/>\n'
+           '  <key id="weight" for="edge" attr.name="weight" attr.type="int"/>\n'
+           '  <graph id="network" edgedefault="undirected">\n')
+    for batch in _batched(graph_manager.iter_nodes()):
+        yield ''.join(
+            f'    <node id="{node}"><data key="username">{escape(username)}</data></node>\n'
+            if username is not None else f'    <node id="{node}"/>\n'
+            for node, username in batch
+        )
+    for batch in _batched(graph_manager.iter_edges()):
+        yield ''.join(
+            f'    <edge source="{u}" target="{v}"><data key="weight">{weight}</data></edge>\n'
+            for u, v, weight in batch
+        )
+    yield '  </graph>\n</graphml>\n'
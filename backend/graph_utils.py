@@ -1,128 +1,778 @@
 import networkx as nx
-import matplotlib.pyplot as plt
-from typing import List, Tuple, Dict
-from database import User, NetworkEdge
+from collections import OrderedDict
+from typing import List, Tuple, Dict, Iterable, Iterator, Optional
+from database import User, NetworkEdge, GraphChange
+from sqlalchemy import func, insert, select, tuple_
+from centrality import CentralityEngine
+from network_stats import ComponentTracker, bfs_eccentricity, sweep_diameter_bounds
+try:
+    from .metrics import timed
+except ImportError:
+    from metrics import timed
+import hashlib
+import heapq
+import json
+import threading
+import time
 import io
 import base64
+import logging
+
+logger = logging.getLogger(__name__)
+
+GRAPH_CHANGE_OPS = ('add_node', 'remove_node', 'add_edge', 'remove_edge')
+
+def _chunks(items: List, size: int = 500) -> Iterator[List]:
+    """Split a list into bound-parameter-sized chunks"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+class _SearchTimeout(Exception):
+    """A bounded path search ran past its deadline"""
+
+def _edge_weight(data: Dict) -> float:
+    weight = data.get('weight')
+    return 1 if weight is None else weight
+
+def _bounded_shortest_path(graph: nx.Graph, source, target, max_hops: Optional[int],
+                           banned_nodes, banned_edges,
+                           deadline: Optional[float]) -> Optional[Tuple[float, List]]:
+    """Lightest loopless path of at most max_hops edges, as (weight, path)
+
+    Dijkstra over (node, hops) labels: a label is skipped when its node was
+    already settled with no more hops, since that one is no heavier. Raises
+    _SearchTimeout as soon as the deadline passes.
+    """
+    labels = [(source, None)]  # (node, parent label)
+    settled_hops = {}
+    heap = [(0, 0, 0, 0)]  # (weight, hops, tie breaker, label)
+    counter = 1
+    while heap:
+        if deadline is not None and time.monotonic() > deadline:
+            raise _SearchTimeout()
+        distance, hops, _, label = heapq.heappop(heap)
+        node = labels[label][0]
+        if node in settled_hops and settled_hops[node] <= hops:
+            continue
+        settled_hops[node] = hops
+        if node == target:
+            path = []
+            while label is not None:
+                path.append(labels[label][0])
+                label = labels[label][1]
+            return distance, path[::-1]
+        if max_hops is not None and hops >= max_hops:
+            continue
+        for neighbor, data in graph.adj[node].items():
+            if neighbor in banned_nodes or (node, neighbor) in banned_edges:
+                continue
+            if neighbor in settled_hops and settled_hops[neighbor] <= hops + 1:
+                continue
+            labels.append((neighbor, label))
+            heapq.heappush(heap, (distance + _edge_weight(data), hops + 1, counter,
+                                  len(labels) - 1))
+            counter += 1
+    return None
+
+def _bounded_simple_paths(graph: nx.Graph, source, target, max_hops: Optional[int],
+                          deadline: Optional[float]) -> Iterator[List]:
+    """Yield loopless paths lightest first (Yen's algorithm) within max_hops
+
+    Every spur search is hop-bounded and deadline-checked, so enumeration
+    stops promptly instead of finishing a search it has no time for.
+    """
+    try:
+        first = _bounded_shortest_path(graph, source, target, max_hops,
+                                       set(), set(), deadline)
+        if first is None:
+            return
+        found = [first[1]]
+        seen = {tuple(first[1])}
+        candidates = []
+        counter = 0
+        yield first[1]
+        while True:
+            previous = found[-1]
+            root_weight = 0
+            for i, spur in enumerate(previous[:-1]):
+                root = previous[:i + 1]
+                banned_edges = {(path[i], path[i + 1]) for path in found
+                                if len(path) > i + 1 and path[:i + 1] == root}
+                spur_hops = max_hops - i if max_hops is not None else None
+                spur_path = _bounded_shortest_path(graph, spur, target, spur_hops,
+                                                   set(root[:-1]), banned_edges, deadline)
+                if spur_path is not None:
+                    path = root[:-1] + spur_path[1]
+                    if tuple(path) not in seen:
+                        seen.add(tuple(path))
+                        heapq.heappush(candidates, (root_weight + spur_path[0], counter, path))
+                        counter += 1
+                root_weight += _edge_weight(graph.adj[spur][previous[i + 1]])
+            if not candidates:
+                return
+            path = heapq.heappop(candidates)[2]
+            found.append(path)
+            yield path
+    except _SearchTimeout:
+        return
 
 class NetworkGraph:
-    def __init__(self, db_session):
+    def __init__(self, db_session, route_cache_size: int = 512,
+                 centrality_sample_threshold: int = 1000,
+                 centrality_sample_size: int = 256,
+                 centrality_background: bool = False,
+                 max_paths: int = 100,
+                 max_path_hops: Optional[int] = None,
+                 path_timeout: Optional[float] = 2.0,
+                 change_log_size: int = 10000,
+                 diameter_exact_limit: int = 1000,
+                 diameter_sweeps: int = 4):
         self.db_session = db_session
         self.graph = nx.Graph()
+
+        # Incremented on every topology change; cached results are only
+        # valid for the version they were computed against
+        self.version = 0
+
+        # Route cache: source node -> {target node: shortest path}, i.e. one
+        # single-source Dijkstra tree per sender, kept in LRU order
+        self.route_cache_size = route_cache_size
+        self._route_cache = OrderedDict()
+        self._route_lock = threading.Lock()
+
+        # Serializes writers to the in-memory graph; synced changes are
+        # applied to a copy that is swapped in, so readers need no lock
+        self._write_lock = threading.RLock()
+
+        # Centralities are computed for all nodes at once and reused until
+        # the version changes
+        self.centrality = CentralityEngine(self,
+                                           sample_threshold=centrality_sample_threshold,
+                                           sample_size=centrality_sample_size,
+                                           background=centrality_background)
+
+        # Network status: counters and components are maintained by every
+        # mutation; the diameter is exact up to diameter_exact_limit nodes,
+        # a diameter_sweeps double-sweep estimate above, cached per version
+        self.edge_count = 0
+        self.components = ComponentTracker(self)
+        self.diameter_exact_limit = diameter_exact_limit
+        self.diameter_sweeps = diameter_sweeps
+        self._diameter_cache = (None, None, None)
+
+        # Default bounds for path enumeration
+        self.max_paths = max_paths
+        self.max_path_hops = max_path_hops
+        self.path_timeout = path_timeout
+
+        # Visualization caches: node positions are kept across versions and
+        # only dirty nodes move; the PNG and JSON export are per version
+        self._layout = {}
+        self._layout_dirty = set()
+        self._render_lock = threading.Lock()
+        self._image_cache = (None, None)
+        self._graph_data_cache = (None, None, None)
+
+        # Change feed: log_version is the last graph_changes entry applied to
+        # this in-memory copy; listeners get each change we commit
+        self.log_version = 0
+        self.change_log_size = change_log_size
+        self.change_log_trim_every = 1000
+        self.change_listeners = []
+
         self.load_graph()
 
+    def _topology_changed(self, *nodes):
+        """Bump the graph version and drop every cached route
+
+        nodes are the ones whose layout position the change affects; with
+        none given, the whole layout is recomputed on next use.
+        """
+        with self._route_lock:
+            self.version += 1
+            self._route_cache.clear()
+            if nodes:
+                self._layout_dirty.update(nodes)
+            else:
+                self._layout = {}
+                self._layout_dirty.clear()
+
     def load_graph(self):
         """Load the network graph from database"""
-        # Load all users as nodes
-        users = self.db_session.query(User).all()
-        for user in users:
-            self.graph.add_node(user.node_id, username=user.username)
+        # Without a session the graph is purely in-memory (e.g. simulations)
+        if self.db_session is None:
+            self._topology_changed()
+            return
+
+        # Everything up to the current change log head is in the tables
+        self.log_version = self.db_session.query(func.max(GraphChange.id)).scalar() or 0
+
+        # Load all users as nodes, streaming plain rows rather than ORM objects
+        users = self.db_session.execute(
+            select(User.node_id, User.username).where(User.node_id.isnot(None))
+            .execution_options(yield_per=50000)
+        )
+        graph = nx.Graph()
+        graph.add_nodes_from((node_id, {'username': username}) for node_id, username in users)
 
         # Load all edges
-        edges = self.db_session.query(NetworkEdge).all()
-        for edge in edges:
-            self.graph.add_edge(edge.node1_id, edge.node2_id, weight=edge.weight)
+        edges = self.db_session.execute(
+            select(NetworkEdge.node1_id, NetworkEdge.node2_id, NetworkEdge.weight)
+            .execution_options(yield_per=50000)
+        )
+        graph.add_weighted_edges_from(edges)
+
+        # Swap the loaded graph in whole, so a reload never shows readers a
+        # half-filled one
+        with self._write_lock:
+            self.graph = graph
+            self.edge_count = graph.number_of_edges()
+            self.components.reset()
+            self._topology_changed()
+
+    def _clear_graph(self):
+        """Drop every node and edge from the in-memory graph"""
+        with self._write_lock:
+            self.graph.clear()
+            self.edge_count = 0
+            self.components.reset()
+
+    def _reload_graph(self):
+        """Replace the in-memory graph with the one in the database"""
+        self.load_graph()
+
+    def _apply_change(self, op: str, node1_id: int, node2_id: Optional[int] = None,
+                      weight: Optional[int] = None, username: Optional[str] = None,
+                      strict: bool = False, graph: Optional[nx.Graph] = None):
+        """Apply one mutation to the in-memory graph only
+
+        Non-strict application ignores removals of things already gone, so
+        replaying a change twice is harmless. graph is the networkx graph
+        to change, by default the live one.
+        """
+        with self._write_lock:
+            if graph is None:
+                graph = self.graph
+            if op == 'add_node':
+                graph.add_node(node1_id, username=username)
+                self.components.node_added(node1_id)
+                self._topology_changed(node1_id)
+            elif op == 'remove_node':
+                if node1_id not in graph and not strict:
+                    return
+                neighbors = list(graph.neighbors(node1_id)) if node1_id in graph else []
+                degree = graph.degree(node1_id) if node1_id in graph else 0
+                graph.remove_node(node1_id)
+                # A self-loop counts twice towards the degree but is one edge
+                self.edge_count -= degree - (1 if node1_id in neighbors else 0)
+                self.components.removed()
+                self._layout.pop(node1_id, None)
+                # Name the node itself too: with no neighbours, an empty list
+                # would throw the whole layout away
+                self._topology_changed(node1_id, *neighbors)
+            elif op == 'add_edge':
+                if not graph.has_edge(node1_id, node2_id):
+                    self.edge_count += 1
+                graph.add_edge(node1_id, node2_id, weight=weight)
+                self.components.edge_added(node1_id, node2_id)
+                self._topology_changed(node1_id, node2_id)
+            elif op == 'remove_edge':
+                if not graph.has_edge(node1_id, node2_id) and not strict:
+                    return
+                graph.remove_edge(node1_id, node2_id)
+                self.edge_count -= 1
+                self.components.removed()
+                self._topology_changed(node1_id, node2_id)
+            else:
+                raise ValueError(f"Unknown graph change: {op}")
+
+    def _record_change(self, op: str, node1_id: int, node2_id: Optional[int] = None,
+                       weight: Optional[int] = None, username: Optional[str] = None) -> GraphChange:
+        """Append a mutation to the change log in the current transaction"""
+        change = GraphChange(op=op, node1_id=node1_id, node2_id=node2_id,
+                             weight=weight, username=username)
+        self.db_session.add(change)
+        return change
+
+    def _changes_committed(self, changes: List[Dict]):
+        """Advance past our own committed changes and tell listeners about them"""
+        first, last = changes[0]['version'], changes[-1]['version']
+        with self._route_lock:
+            # Only skip ahead if no other worker's change came in between
+            if first == self.log_version + 1 and last - first + 1 == len(changes):
+                self.log_version = last
+
+        if (first - 1) // self.change_log_trim_every < last // self.change_log_trim_every:
+            self.trim_change_log()
+
+        for listener in self.change_listeners:
+            try:
+                listener(changes)
+            except Exception:
+                logger.exception("Graph change listener failed")
 
     def add_node(self, node_id: int, username: str):
         """Add a new node to the graph"""
-        self.graph.add_node(node_id, username=username)
+        self._apply_change('add_node', node_id, username=username, strict=True)
+        if self.db_session is None:
+            return
+
+        change = self._record_change('add_node', node_id, username=username)
+        self.db_session.commit()
+        self._changes_committed([change.to_dict()])
 
     def remove_node(self, node_id: int):
         """Remove a node from the graph"""
-        self.graph.remove_node(node_id)
+        self._apply_change('remove_node', node_id, strict=True)
+        if self.db_session is None:
+            return
+
         # Clean up database
         self.db_session.query(NetworkEdge).filter(
             (NetworkEdge.node1_id == node_id) | (NetworkEdge.node2_id == node_id)
         ).delete()
+        change = self._record_change('remove_node', node_id)
         self.db_session.commit()
+        self._changes_committed([change.to_dict()])
 
     def add_edge(self, node1_id: int, node2_id: int, weight: int = 1):
         """Add an edge between two nodes"""
-        self.graph.add_edge(node1_id, node2_id, weight=weight)
+        self._apply_change('add_edge', node1_id, node2_id, weight=weight, strict=True)
+        if self.db_session is None:
+            return
         
-        # Add to database
-        edge = NetworkEdge(node1_id=node1_id, node2_id=node2_id, weight=weight)
-        self.db_session.add(edge)
+        # Add to database, updating the weight if the edge is already stored
+        low, high = NetworkEdge.canonical_pair(node1_id, node2_id)
+        edge = self.db_session.query(NetworkEdge).filter_by(node1_id=low, node2_id=high).first()
+        if edge:
+            edge.weight = weight
+        else:
+            edge = NetworkEdge(node1_id=low, node2_id=high, weight=weight)
+            self.db_session.add(edge)
+        change = self._record_change('add_edge', low, high, weight=weight)
         self.db_session.commit()
+        self._changes_committed([change.to_dict()])
 
     def remove_edge(self, node1_id: int, node2_id: int):
         """Remove an edge between two nodes"""
-        self.graph.remove_edge(node1_id, node2_id)
+        self._apply_change('remove_edge', node1_id, node2_id, strict=True)
+        if self.db_session is None:
+            return
         
         # Remove from database
-        self.db_session.query(NetworkEdge).filter(
-            ((NetworkEdge.node1_id == node1_id) & (NetworkEdge.node2_id == node2_id)) |
-            ((NetworkEdge.node1_id == node2_id) & (NetworkEdge.node2_id == node1_id))
-        ).delete()
+        low, high = NetworkEdge.canonical_pair(node1_id, node2_id)
+        self.db_session.query(NetworkEdge).filter_by(node1_id=low, node2_id=high).delete()
+        change = self._record_change('remove_edge', low, high)
         self.db_session.commit()
+        self._changes_committed([change.to_dict()])
+
+    def apply_changes(self, changes: Iterable[Dict]) -> int:
+        """Apply a batch of mutations atomically, in one transaction
+
+        Each change is a dict with an 'op' (add_node, remove_node, add_edge
+        or remove_edge) and the node1_id, node2_id, weight and username
+        fields it uses. Either every change is stored and applied or none
+        is; removing a node or edge that is already gone is not an error.
+        Returns the number of changes applied.
+        """
+        changes = [self._normalize_change(change) for change in changes]
+        if not changes:
+            return 0
+
+        if self.db_session is not None:
+            try:
+                self._persist_changes(changes)
+                versions = self.db_session.scalars(
+                    insert(GraphChange).returning(GraphChange.id, sort_by_parameter_order=True),
+                    changes
+                ).all()
+                self.db_session.commit()
+            except Exception:
+                self.db_session.rollback()
+                raise
+
+        for change in changes:
+            self._apply_change(change['op'], change['node1_id'], change['node2_id'],
+                               weight=change['weight'], username=change['username'])
+
+        if self.db_session is not None:
+            for change, version in zip(changes, versions):
+                change['version'] = version
+            self._changes_committed(changes)
+        return len(changes)
 
-    def get_shortest_path(self, source_id: int, target_id: int) -> List[int]:
-        """Find the shortest path between two nodes using Dijkstra's algorithm"""
+    def _normalize_change(self, change: Dict) -> Dict:
+        """Validate a batch entry and fill in the fields it leaves out"""
+        op = change.get('op')
+        if op not in GRAPH_CHANGE_OPS:
+            raise ValueError(f"Unknown graph change: {op}")
         try:
-            path = nx.dijkstra_path(self.graph, source_id, target_id, weight='weight')
-            return path
-        except nx.NetworkXNoPath:
+            node1_id = int(change['node1_id'])
+            node2_id = int(change['node2_id']) if op in ('add_edge', 'remove_edge') else None
+            weight = int(change.get('weight') or 1) if op == 'add_edge' else None
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Invalid {op} change: {change}")
+        if weight is not None and weight < 1:
+            raise ValueError(f"Edge weight must be positive: {change}")
+
+        if node2_id is not None:
+            node1_id, node2_id = NetworkEdge.canonical_pair(node1_id, node2_id)
+        return {
+            'op': op,
+            'node1_id': node1_id,
+            'node2_id': node2_id,
+            'weight': weight,
+            'username': change.get('username') if op == 'add_node' else None
+        }
+
+    def _persist_changes(self, changes: List[Dict]):
+        """Write the net edge changes of a batch, without committing"""
+        # Collapse the batch: each touched pair ends up with a weight, or
+        # None when the last thing that happened to it was a removal
+        removed_nodes = []
+        edges = {}
+        pairs_by_node = {}
+        for change in changes:
+            if change['op'] == 'remove_node':
+                node = change['node1_id']
+                removed_nodes.append(node)
+                for pair in pairs_by_node.pop(node, ()):
+                    edges[pair] = None
+            elif change['op'] in ('add_edge', 'remove_edge'):
+                pair = (change['node1_id'], change['node2_id'])
+                edges[pair] = change['weight']
+                for node in pair:
+                    pairs_by_node.setdefault(node, set()).add(pair)
+
+        for chunk in _chunks(removed_nodes):
+            self.db_session.query(NetworkEdge).filter(
+                NetworkEdge.node1_id.in_(chunk) | NetworkEdge.node2_id.in_(chunk)
+            ).delete(synchronize_session=False)
+        for chunk in _chunks(list(edges)):
+            self.db_session.query(NetworkEdge).filter(
+                tuple_(NetworkEdge.node1_id, NetworkEdge.node2_id).in_(chunk)
+            ).delete(synchronize_session=False)
+
+        rows = [{'node1_id': low, 'node2_id': high, 'weight': weight}
+                for (low, high), weight in edges.items() if weight is not None]
+        if rows:
+            self.db_session.execute(insert(NetworkEdge), rows)
+
+    def iter_nodes(self) -> Iterator[Tuple[int, Optional[str]]]:
+        """Yield (node id, username) for every node, from a snapshot"""
+        yield from list(self.graph.nodes(data='username'))
+
+    def iter_edges(self) -> Iterator[Tuple[int, int, int]]:
+        """Yield (node1 id, node2 id, weight) for every edge, from a snapshot"""
+        yield from list(self.graph.edges(data='weight', default=1))
+
+    def get_changes_since(self, since: int, limit: int = 1000) -> Dict:
+        """Get logged mutations after a version, oldest first
+
+        'reset' is set when the log no longer reaches back to since (or since
+        is ahead of it); the caller must then reload the full graph.
+        """
+        head = self.db_session.query(func.max(GraphChange.id)).scalar() or 0
+        oldest = self.db_session.query(func.min(GraphChange.id)).scalar()
+        if since > head or (oldest is not None and since < oldest - 1):
+            return {'version': head, 'reset': True, 'changes': [], 'has_more': False}
+
+        changes = self.db_session.query(GraphChange).filter(
+            GraphChange.id > since
+        ).order_by(GraphChange.id).limit(limit + 1).all()
+        has_more = len(changes) > limit
+        changes = [change.to_dict() for change in changes[:limit]]
+        return {
+            'version': changes[-1]['version'] if changes else since,
+            'reset': False,
+            'changes': changes,
+            'has_more': has_more
+        }
+
+    def sync_changes(self) -> int:
+        """Apply other workers' mutations from the change log
+
+        Returns the number of changes applied. Falls back to a full reload
+        when the log has been trimmed past this worker's version.
+        """
+        if self.db_session is None:
+            return 0
+
+        applied = 0
+        while True:
+            feed = self.get_changes_since(self.log_version)
+            if feed['reset']:
+                self._reload_graph()
+                return applied
+
+            if feed['changes']:
+                self._apply_synced(feed['changes'])
+                applied += len(feed['changes'])
+            if not feed['has_more']:
+                return applied
+
+    def _apply_synced(self, changes: List[Dict]):
+        """Apply logged changes to a copy of the graph and swap it in
+
+        Readers keep whichever graph object they started with, which is
+        never changed afterwards. The final version bump comes after the
+        swap, so nothing computed from the old graph is cached as current.
+        """
+        with self._write_lock:
+            graph = self.graph.copy()
+            for change in changes:
+                self._apply_change(change['op'], change['node1_id'], change['node2_id'],
+                                   weight=change['weight'], username=change['username'],
+                                   graph=graph)
+            self.graph = graph
+            self.log_version = changes[-1]['version']
+            # Components were updated (or rebuilt) against the old graph
+            self.components.reset()
+            self._topology_changed(*{node for change in changes
+                                     for node in (change['node1_id'], change['node2_id'])
+                                     if node is not None})
+
+    def trim_change_log(self, keep: Optional[int] = None):
+        """Drop all but the newest keep entries of the change log"""
+        keep = self.change_log_size if keep is None else keep
+        head = self.db_session.query(func.max(GraphChange.id)).scalar() or 0
+        self.db_session.query(GraphChange).filter(GraphChange.id <= head - keep).delete()
+        self.db_session.commit()
+
+    @timed('get_shortest_path')
+    def get_shortest_path(self, source_id: int, target_id: int,
+                          build_tree: bool = True) -> List[int]:
+        """Find the shortest path between two nodes using Dijkstra's algorithm
+
+        With build_tree=False a missing tree isn't built; the single pair is
+        answered with a bidirectional search instead, which is cheaper for
+        one-off lookups such as relay reroutes.
+        """
+        if not build_tree:
+            with self._route_lock:
+                tree = self._route_cache.get(source_id)
+            if tree is None:
+                try:
+                    return nx.bidirectional_dijkstra(self.graph, source_id, target_id,
+                                                     weight='weight')[1]
+                except nx.NetworkXNoPath:
+                    return None
+        else:
+            tree = self.get_shortest_path_tree(source_id)
+
+        path = tree.get(target_id)
+        if path is None:
             return None
+        return list(path)
+
+    def get_shortest_path_tree(self, source_id: int) -> Dict[int, List[int]]:
+        """Get the shortest paths from a node to every reachable node
+
+        One Dijkstra run answers every destination from the sender; the tree
+        is cached until the topology changes.
+        """
+        with self._route_lock:
+            tree = self._route_cache.get(source_id)
+            if tree is not None:
+                self._route_cache.move_to_end(source_id)
+                return tree
+            version = self.version
+
+        tree = nx.single_source_dijkstra_path(self.graph, source_id, weight='weight')
+
+        with self._route_lock:
+            # Don't cache a tree computed against a graph that has since changed
+            if version == self.version and self.route_cache_size > 0:
+                self._route_cache[source_id] = tree
+                while len(self._route_cache) > self.route_cache_size:
+                    self._route_cache.popitem(last=False)
+        return tree
+
+    def precompute_routes(self, source_ids: Optional[Iterable[int]] = None):
+        """Warm the route cache with shortest-path trees for the given nodes"""
+        if source_ids is None:
+            source_ids = list(self.graph.nodes)
+        for source_id in source_ids:
+            if source_id in self.graph:
+                self.get_shortest_path_tree(source_id)
 
     def get_node_connections(self, node_id: int) -> List[Tuple[int, str]]:
         """Get all nodes connected to a given node"""
         if node_id in self.graph:
             neighbors = self.graph.neighbors(node_id)
-            return [(n, self.graph.nodes[n]['username']) for n in neighbors]
+            return [(n, self.graph.nodes[n].get('username')) for n in neighbors]
         return []
 
     def get_network_status(self) -> Dict:
-        """Get overall network statistics"""
+        """Get overall network statistics
+
+        Counts come from counters the mutations keep current and the
+        diameter (in hops) from a per-version cache; diameter_exact is False
+        when it is a double-sweep lower bound rather than the exact value.
+        """
+        node_count = self.graph.number_of_nodes()
+        edge_count = self.edge_count
+        components = self.components.count() if node_count else 0
+        diameter, exact = self._get_diameter(components == 1)
         return {
-            'total_nodes': self.graph.number_of_nodes(),
-            'total_edges': self.graph.number_of_edges(),
-            'average_degree': sum(dict(self.graph.degree()).values()) / self.graph.number_of_nodes() if self.graph.number_of_nodes() > 0 else 0,
-            'diameter': nx.diameter(self.graph) if nx.is_connected(self.graph) and self.graph.number_of_nodes() > 0 else float('inf'),
-            'density': nx.density(self.graph),
-            'is_connected': nx.is_connected(self.graph)
+            'total_nodes': node_count,
+            'total_edges': edge_count,
+            'average_degree': 2 * edge_count / node_count if node_count > 0 else 0,
+            'diameter': diameter,
+            'diameter_exact': exact,
+            'density': 2 * edge_count / (node_count * (node_count - 1)) if node_count > 1 else 0,
+            'is_connected': components == 1,
+            'components': components
         }
 
+    def _get_diameter(self, is_connected: bool) -> Tuple[float, bool]:
+        """Diameter and whether it is exact, computed once per graph version"""
+        version, diameter, exact = self._diameter_cache
+        if version == self.version:
+            return diameter, exact
+
+        version = self.version
+        if not is_connected:
+            diameter, exact = float('inf'), True
+        else:
+            # Traverse a copy so concurrent mutations can't break the BFS
+            graph = self.graph.copy()
+            if graph.number_of_nodes() <= self.diameter_exact_limit:
+                diameter, exact = nx.diameter(graph, usebounds=True), True
+            else:
+                lower, upper = sweep_diameter_bounds(bfs_eccentricity(graph), next(iter(graph)),
+                                                     self.diameter_sweeps)
+                diameter, exact = lower, lower == upper
+
+        self._diameter_cache = (version, diameter, exact)
+        return diameter, exact
+
+    @timed('get_node_centrality')
     def get_node_centrality(self, node_id: int) -> Dict:
         """Calculate various centrality metrics for a node"""
-        degree_centrality = nx.degree_centrality(self.graph)[node_id]
-        betweenness_centrality = nx.betweenness_centrality(self.graph)[node_id]
-        closeness_centrality = nx.closeness_centrality(self.graph)[node_id]
-        
-        return {
-            'degree_centrality': degree_centrality,
-            'betweenness_centrality': betweenness_centrality,
-            'closeness_centrality': closeness_centrality
+        centrality = self.centrality.get_node_centrality(node_id)
+        if centrality is None:
+            raise KeyError(node_id)
+        return centrality
+
+    def get_layout(self) -> Dict[int, Tuple[float, float]]:
+        """Get node positions, warm-starting from the previous layout
+
+        Only nodes added or touched by a mutation since the last call are
+        repositioned; everything else stays where it was.
+        """
+        with self._route_lock:
+            previous = dict(self._layout)
+            dirty = set(self._layout_dirty)
+            version = self.version
+
+        nodes = list(self.graph.nodes)
+        moving = [node for node in nodes if node not in previous or node in dirty]
+        if previous and not moving:
+            return previous
+
+        if not previous or len(moving) == len(nodes):
+            pos = nx.spring_layout(self.graph, seed=version) if nodes else {}
+        else:
+            # Seed each new node at its placed neighbours' centroid
+            initial = {node: previous[node] for node in nodes if node in previous}
+            for node in moving:
+                if node not in initial:
+                    placed = [initial[n] for n in self.graph.neighbors(node) if n in initial]
+                    if placed:
+                        initial[node] = tuple(sum(axis) / len(placed) for axis in zip(*placed))
+            fixed = [node for node in initial if node not in moving]
+            pos = nx.spring_layout(self.graph, pos=initial or None, fixed=fixed or None,
+                                   iterations=20, seed=version)
+        pos = {node: (float(x), float(y)) for node, (x, y) in pos.items()}
+
+        with self._route_lock:
+            if version == self.version:
+                self._layout = pos
+                self._layout_dirty.clear()
+        return pos
+
+    def get_graph_data(self) -> Tuple[Dict, str]:
+        """Get the topology as D3-style JSON data with a content ETag, cached per version"""
+        version, data, etag = self._graph_data_cache
+        if version == self.version:
+            return data, etag
+
+        version = self.version
+        data = {
+            'version': version,
+            # Clients pass this to get_changes_since to stay current
+            'log_version': self.log_version,
+            'nodes': [{'id': node, 'username': attrs.get('username')}
+                      for node, attrs in self.graph.nodes(data=True)],
+            'links': [{'source': u, 'target': v, 'weight': attrs.get('weight', 1)}
+                      for u, v, attrs in self.graph.edges(data=True)]
         }
+        # Hash the whole body, version fields included, so a 304 never
+        # leaves a client holding stale versions
+        payload = json.dumps(data, sort_keys=True)
+        etag = hashlib.sha1(payload.encode()).hexdigest()
+        self._graph_data_cache = (version, data, etag)
+        return data, etag
 
+    @timed('visualize_graph')
     def visualize_graph(self) -> str:
         """Generate a visualization of the network graph"""
-        plt.figure(figsize=(10, 8))
-        pos = nx.spring_layout(self.graph)
-        
-        # Draw nodes
-        nx.draw_networkx_nodes(self.graph, pos, node_color='lightblue', 
-                             node_size=500)
-        
-        # Draw edges
-        nx.draw_networkx_edges(self.graph, pos)
-        
-        # Draw labels
-        labels = nx.get_node_attributes(self.graph, 'username')
-        nx.draw_networkx_labels(self.graph, pos, labels)
-        
-        # Save plot to a base64 string
-        img = io.BytesIO()
-        plt.savefig(img, format='png')
-        img.seek(0)
-        plt.close()
-        
-        return base64.b64encode(img.getvalue()).decode()
+        version, image = self._image_cache
+        if version == self.version:
+            return image
+
+        with self._render_lock:
+            version, image = self._image_cache
+            if version == self.version:
+                return image
+
+            version = self.version
+            pos = self.get_layout()
+
+            # matplotlib is only needed here, so it's imported on first render,
+            # headless. Drawing on our own Figure keeps pyplot's global state
+            # out of concurrent renders
+            import matplotlib
+            matplotlib.use('Agg')
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+            figure = Figure(figsize=(10, 8))
+            FigureCanvasAgg(figure)
+            ax = figure.add_subplot()
+
+            # Draw nodes
+            nx.draw_networkx_nodes(self.graph, pos, node_color='lightblue', 
+                                 node_size=500, ax=ax)
+            
+            # Draw edges
+            nx.draw_networkx_edges(self.graph, pos, ax=ax)
+            
+            # Draw labels
+            labels = nx.get_node_attributes(self.graph, 'username')
+            nx.draw_networkx_labels(self.graph, pos, labels, ax=ax)
+            
+            # Save plot to a base64 string
+            img = io.BytesIO()
+            figure.savefig(img, format='png')
+
+            image = base64.b64encode(img.getvalue()).decode()
+            self._image_cache = (version, image)
+            return image
+
+    def create_demo_graph(self) -> bool:
+        """Create a demo graph with 6 nodes, unless the network already has data
+
+        Returns whether anything was written, so restarts (and every worker
+        after the first) don't rewrite the topology and change log.
+        """
+        # Any edge, or any logged change (the topology may have been emptied
+        # on purpose), means the network isn't fresh
+        for model in (NetworkEdge, GraphChange):
+            if self.db_session.query(model.id).first() is not None:
+                return False
 
-    def create_demo_graph(self):
-        """Create a demo graph with 6 nodes"""
-        # Clear existing graph
-        self.graph.clear()
-        
         # Add nodes
         demo_users = [
             ('user1', 'upassword1'),
@@ -133,24 +783,79 @@ class NetworkGraph:
             ('user6', 'upassword6')
         ]
         
-        for i, (username, password) in enumerate(demo_users, 1):
-            self.add_node(i, username)
+        changes = [{'op': 'add_node', 'node1_id': i, 'username': username}
+                   for i, (username, password) in enumerate(demo_users, 1)]
             
         # Add edges to create a complex network
         edges = [
             (1, 2), (1, 3), (2, 4), (3, 4), (3, 5),
             (4, 5), (4, 6), (5, 6), (2, 3), (1, 6)
         ]
-        
-        for node1, node2 in edges:
-            self.add_edge(node1, node2)
+        changes.extend({'op': 'add_edge', 'node1_id': node1, 'node2_id': node2}
+                       for node1, node2 in edges)
 
-    def get_all_paths(self, source_id: int, target_id: int) -> List[List[int]]:
-        """Get all possible paths between two nodes"""
-        try:
-            return list(nx.all_simple_paths(self.graph, source_id, target_id))
-        except nx.NetworkXNoPath:
-            return []
+        self.apply_changes(changes)
+        return True
+
+    def iter_paths(self, source_id: int, target_id: int,
+                   max_paths: Optional[int] = None,
+                   max_hops: Optional[int] = None,
+                   timeout: Optional[float] = None) -> Iterator[List[int]]:
+        """Yield loopless paths between two nodes, shortest first
+
+        Paths are produced lazily (Yen's algorithm) and enumeration stops
+        after max_paths paths or once timeout seconds have passed. With
+        max_hops, no path longer than that many edges is explored. Each
+        search step checks the deadline, so a single expensive spur search
+        can't overrun it. Bounds left as None fall back to the graph
+        defaults.
+        """
+        if max_paths is None:
+            max_paths = self.max_paths
+        if max_hops is None:
+            max_hops = self.max_path_hops
+        if timeout is None:
+            timeout = self.path_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        if source_id not in self.graph or target_id not in self.graph:
+            return
+
+        # Enumerate over a snapshot so concurrent mutations can't break the generator
+        graph = self.graph.copy()
+        paths = _bounded_simple_paths(graph, source_id, target_id, max_hops, deadline)
+        for count, path in enumerate(paths, 1):
+            yield path
+            if max_paths is not None and count >= max_paths:
+                return
+
+    def get_all_paths(self, source_id: int, target_id: int,
+                      max_paths: Optional[int] = None,
+                      max_hops: Optional[int] = None,
+                      timeout: Optional[float] = None) -> List[List[int]]:
+        """Get the possible paths between two nodes, within the enumeration bounds"""
+        return list(self.iter_paths(source_id, target_id, max_paths=max_paths,
+                                    max_hops=max_hops, timeout=timeout))
+
+    def get_ranked_paths(self, source_id: int, target_id: int, k: int = 5,
+                         max_paths: Optional[int] = None,
+                         max_hops: Optional[int] = None,
+                         timeout: Optional[float] = None) -> List[Tuple[List[int], float]]:
+        """Get the k candidate paths with the lowest security metric
+
+        Candidates are streamed from iter_paths and only the best k are kept
+        in memory.
+        """
+        centralities = self.centrality.get_betweenness()
+        candidates = self.iter_paths(source_id, target_id, max_paths=max_paths,
+                                     max_hops=max_hops, timeout=timeout)
+        scored = ((path, self._score_path(path, centralities)) for path in candidates)
+        return heapq.nsmallest(k, scored, key=lambda item: item[1])
+
+    def _score_path(self, path: List[int], centralities: Dict[int, float]) -> float:
+        """Average betweenness centrality of the nodes in a path"""
+        path_centralities = [centralities.get(node, 0.0) for node in path]
+        return sum(path_centralities) / len(path_centralities)
 
     def get_path_security_metric(self, path: List[int]) -> float:
         """Calculate security metric for a path based on node centrality"""
@@ -158,6 +863,4 @@ class NetworkGraph:
             return 0.0
         
         # Calculate average betweenness centrality of nodes in path
-        centralities = nx.betweenness_centrality(self.graph)
-        path_centralities = [centralities[node] for node in path]
-        return sum(path_centralities) / len(path_centralities)
\ No newline at end of file
+        return self._score_path(path, self.centrality.get_betweenness())
\ No newline at end of file
@@ -0,0 +1,165 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime
+from typing import List, Optional, Tuple
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class IngestQueueFull(Exception):
+    """Raised when the ingestion queue stays full past the submit timeout"""
+
+class MessageIngestQueue:
+    """Write-behind message ingestion with group commit
+
+    Accepted messages wait in a bounded in-memory queue. A single writer
+    thread drains them and stores a batch per transaction, committing once
+    batch_size messages are collected or max_delay seconds have passed since
+    the first one. Each submit returns a Future that resolves to the usual
+    (success, message) tuple once its batch has committed.
+    """
+
+    def __init__(self, message_handler, maxsize: int = 10000, batch_size: int = 500,
+                 max_delay: float = 0.01, put_timeout: float = 1.0,
+                 ack_timeout: float = 5.0, teardown=None):
+        self.message_handler = message_handler
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        # How long send waits for a queued message's batch to commit, on top
+        # of the batch's max_delay; bounds the wait if the writer is gone
+        self.ack_timeout = ack_timeout
+        # Called when the writer exits, e.g. to release its DB session
+        self.teardown = teardown
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name='message-ingest', daemon=True)
+        self._writer.start()
+
+    def submit(self, sender_id: int, receiver_id: int, message: str,
+               timeout: Optional[float] = None) -> Future:
+        """Queue a message, blocking up to timeout seconds while the queue is full"""
+        if self._closed:
+            raise RuntimeError("Ingestion queue is shut down")
+
+        ack = Future()
+        try:
+            self._queue.put((sender_id, receiver_id, message, ack),
+                            timeout=self.put_timeout if timeout is None else timeout)
+        except queue.Full:
+            raise IngestQueueFull("Message queue is full, please retry")
+        return ack
+
+    def send(self, sender_id: int, receiver_id: int, message: str) -> Tuple[bool, str]:
+        """Queue a message and wait (boundedly) until it is durably stored"""
+        try:
+            ack = self.submit(sender_id, receiver_id, message)
+        except (IngestQueueFull, RuntimeError) as e:
+            return False, str(e)
+
+        try:
+            return ack.result(timeout=self.max_delay + self.ack_timeout)
+        except FutureTimeoutError:
+            logger.warning("Message from %s to %s not confirmed within %.1f s",
+                           sender_id, receiver_id, self.max_delay + self.ack_timeout)
+            return False, "Message not confirmed in time, it may or may not have been stored"
+
+    def pending(self) -> int:
+        """Number of messages waiting to be written"""
+        return self._queue.qsize()
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """Stop accepting messages and flush everything already queued"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+    def _collect(self) -> Tuple[List[tuple], bool]:
+        """Block for the first message, then gather a batch until full or due"""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch: List[tuple]):
+        """Store one batch in a single transaction and resolve its acks"""
+        handler = self.message_handler
+        session = handler.db_session
+        try:
+            _, failures = handler._resolve_receivers(
+                [(sender_id, receiver_id) for sender_id, receiver_id, _, _ in batch]
+            )
+
+            rows = []
+            accepted = []
+            sent_at = datetime.utcnow()
+            for index, (sender_id, receiver_id, message, ack) in enumerate(batch):
+                if index in failures:
+                    continue
+                try:
+                    encrypted_content = handler.crypto_manager.encrypt_message(message, receiver_id)
+                except Exception as e:
+                    failures[index] = f"Error sending message: {str(e)}"
+                    continue
+                rows.append({
+                    'sender_id': sender_id,
+                    'receiver_id': receiver_id,
+                    'encrypted_content': encrypted_content,
+                    'sent_at': sent_at,
+                    'read': False
+                })
+                accepted.append(ack)
+
+            if rows:
+                handler._insert_messages(rows)
+                session.commit()
+
+        except Exception as e:
+            session.rollback()
+            logger.exception("Message batch of %d failed", len(batch))
+            for _, _, _, ack in batch:
+                ack.set_result((False, f"Error sending message: {str(e)}"))
+            return
+
+        for ack in accepted:
+            ack.set_result((True, "Message sent successfully"))
+        for index, reason in failures.items():
+            batch[index][3].set_result((False, reason))
+        handler._notify_delivered(rows)
+
+    def _run(self):
+        try:
+            done = False
+            while not done:
+                batch, done = self._collect()
+                if batch:
+                    self._write(batch)
+
+            # Drain anything queued after the shutdown marker
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self._write([item])
+        finally:
+            if self.teardown:
+                self.teardown()
@@ -1,30 +1,101 @@
-from database import Message, User
+from database import Message, User, UserMessageStats
+from sqlalchemy import bindparam, func, insert, or_, select, union, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from crypto_utils import CryptoManager
-from datetime import datetime
-from typing import List, Dict
+try:
+    from .metrics import timed
+except ImportError:
+    from metrics import timed
+from sqlalchemy.orm import aliased
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from typing import Iterable, List, Dict, Optional, Set, Tuple
+import base64
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Dialects with INSERT ... ON CONFLICT for the counter upserts; others
+# fall back to an INSERT in a savepoint
+UPSERT_INSERTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+def encode_cursor(sent_at: datetime, message_id: int) -> str:
+    """Encode a message position as an opaque pagination cursor"""
+    raw = f"{sent_at.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode a pagination cursor, raising ValueError if it is malformed"""
+    try:
+        sent_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(sent_at), int(message_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
 
 class MessageHandler:
-    def __init__(self, db_session, graph_manager):
+    def __init__(self, db_session, graph_manager, page_size: int = 50,
+                 max_page_size: int = 200, retention_days: Optional[int] = None,
+                 read_session=None, crypto_manager=None):
         self.db_session = db_session
+        # History and dashboard reads can use a separate read-only pool
+        self.read_session = read_session or db_session
         self.graph_manager = graph_manager
-        self.crypto_manager = CryptoManager()
+        self.crypto_manager = crypto_manager or CryptoManager()
+
+        # History reads are windowed; messages older than the retention
+        # period are never returned
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.retention_days = retention_days
 
+        # Optional MessageIngestQueue; when set, sends are group-committed
+        self.ingest_queue = None
+
+        # Optional RelayEngine; when set, messages travel the path hop by
+        # hop and are only stored once they reach the receiver
+        self.relay_engine = None
+
+        # Optional realtime notifier (e.g. SocketIONotifier), told about
+        # every message once it has committed
+        self.notifier = None
+
+    @timed('send_message')
     def send_message(self, sender_id: int, receiver_id: int, message: str) -> bool:
         """Send an encrypted message from sender to receiver"""
+        if self.ingest_queue is not None:
+            # Returns once the batch holding this message has committed
+            return self.ingest_queue.send(sender_id, receiver_id, message)
+
         try:
             # Get the shortest path
             path = self.graph_manager.get_shortest_path(sender_id, receiver_id)
             if not path:
                 return False, "No valid path found between sender and receiver"
 
-            # Get receiver's key
-            receiver = self.db_session.query(User).filter_by(node_id=receiver_id).first()
+            # Relay it along the path before storing it for the receiver
+            if self.relay_engine is not None:
+                try:
+                    delivery = self.relay_engine.submit(sender_id, receiver_id, path=path).result(
+                        timeout=self.relay_engine.delivery_timeout
+                    )
+                except FutureTimeoutError:
+                    logger.warning("Relay of message from %s to %s timed out after %.1f s",
+                                   sender_id, receiver_id, self.relay_engine.delivery_timeout)
+                    return False, (f"Message relay timed out after "
+                                   f"{self.relay_engine.delivery_timeout:g} seconds")
+                if not delivery['delivered']:
+                    return False, delivery['reason']
+
+            # Check the receiver exists
+            receiver = self.db_session.query(User.id).filter_by(node_id=receiver_id).first()
             if not receiver:
                 return False, "Receiver not found"
 
-            # Encrypt message
-            encrypted_content = self.crypto_manager.encrypt_message(message, receiver.password.encode())
+            # Encrypt message with the receiver's derived key
+            encrypted_content = self.crypto_manager.encrypt_message(message, receiver_id)
 
             # Create message record
             new_message = Message(
@@ -36,85 +107,450 @@ class MessageHandler:
             )
 
             self.db_session.add(new_message)
+            self.db_session.flush()
+            if sender_id == receiver_id:
+                self._bump_counters(sender_id, sent=1, received=1, unread=1)
+            else:
+                self._bump_counters(sender_id, sent=1)
+                self._bump_counters(receiver_id, received=1, unread=1)
+            delivered = {
+                'id': new_message.id,
+                'sender_id': sender_id,
+                'receiver_id': receiver_id,
+                'encrypted_content': encrypted_content,
+                'sent_at': new_message.sent_at
+            }
             self.db_session.commit()
+            self._notify_delivered([delivered])
 
             return True, "Message sent successfully"
 
         except Exception as e:
+            self.db_session.rollback()
             return False, f"Error sending message: {str(e)}"
 
-    def get_unread_messages(self, user_id: int) -> List[Dict]:
-        """Get all unread messages for a user"""
-        unread_messages = self.db_session.query(Message).filter_by(
-            receiver_id=user_id,
-            read=False
+    @timed('send_messages_bulk')
+    def send_messages_bulk(self, sender_id: int, receiver_ids: Iterable[int],
+                           message: str) -> Tuple[bool, str, Dict[int, str]]:
+        """Send one message to many receivers in a single transaction
+
+        Routes come from one shortest-path tree rooted at the sender, all
+        receivers are loaded in one query and every row goes in with a single
+        bulk insert. Returns (success, summary, {receiver_id: failure reason}).
+        """
+        receiver_ids = list(dict.fromkeys(receiver_ids))
+        failed = {}
+        try:
+            receivers, failures = self._resolve_receivers(
+                [(sender_id, receiver_id) for receiver_id in receiver_ids]
+            )
+            failed = {receiver_ids[index]: reason for index, reason in failures.items()}
+            deliverable = [receiver_id for receiver_id in receiver_ids if receiver_id not in failed]
+            if not deliverable:
+                return False, "No messages sent", failed
+
+            encrypted = self.crypto_manager.encrypt_messages(message, deliverable)
+            sent_at = datetime.utcnow()
+            rows = [{
+                'sender_id': sender_id,
+                'receiver_id': receiver_id,
+                'encrypted_content': encrypted_content,
+                'sent_at': sent_at,
+                'read': False
+            } for receiver_id, encrypted_content in zip(deliverable, encrypted)]
+            self._insert_messages(rows)
+            self.db_session.commit()
+            self._notify_delivered(rows)
+
+            return True, f"Sent {len(deliverable)} of {len(receiver_ids)} messages", failed
+
+        except Exception as e:
+            self.db_session.rollback()
+            return False, f"Error sending messages: {str(e)}", failed
+
+    def _resolve_receivers(self, pairs: List[Tuple[int, int]]) -> Tuple[Set[int], Dict[int, str]]:
+        """Check routes and look up receivers for (sender_id, receiver_id) pairs
+
+        Each sender costs one shortest-path tree and all receivers are loaded
+        in one query. Returns ({receiver node_ids that exist}, {pair index:
+        failure reason}).
+        """
+        routes = {}
+        for sender_id in {sender_id for sender_id, _ in pairs}:
+            try:
+                routes[sender_id] = self.graph_manager.get_shortest_path_tree(sender_id)
+            except Exception:
+                routes[sender_id] = {}
+
+        receivers = {
+            node_id for (node_id,) in self.db_session.query(User.node_id).filter(
+                User.node_id.in_({receiver_id for _, receiver_id in pairs})
+            )
+        }
+
+        failures = {}
+        for index, (sender_id, receiver_id) in enumerate(pairs):
+            if not routes[sender_id].get(receiver_id):
+                failures[index] = "No valid path found between sender and receiver"
+            elif receiver_id not in receivers:
+                failures[index] = "Receiver not found"
+        return receivers, failures
+
+    def _insert_messages(self, rows: List[Dict]):
+        """Bulk insert message rows and update counters, without committing
+
+        Each row dict gets its new message id under 'id'.
+        """
+        ids = self.db_session.scalars(
+            insert(Message).returning(Message.id, sort_by_parameter_order=True), rows
         ).all()
+        for row, message_id in zip(rows, ids):
+            row['id'] = message_id
+
+        deltas = {}
+        for row in rows:
+            deltas.setdefault(row['sender_id'], [0, 0, 0])[0] += 1
+            receiver = deltas.setdefault(row['receiver_id'], [0, 0, 0])
+            receiver[1] += 1
+            receiver[2] += 1
+        self._bump_counters_bulk(deltas)
+
+    def broadcast_message(self, sender_id: int, message: str) -> Tuple[bool, str, Dict[int, str]]:
+        """Send a message to every other node in the network"""
+        receiver_ids = [node for node in self.graph_manager.graph.nodes if node != sender_id]
+        return self.send_messages_bulk(sender_id, receiver_ids, message)
+
+    def _notify_delivered(self, rows: List[Dict]):
+        """Push committed messages and receivers' unread counts to the notifier"""
+        if self.notifier is None or not rows:
+            return
+
+        try:
+            receiver_ids = {row['receiver_id'] for row in rows}
+            try:
+                unread = dict(self.read_session.query(
+                    UserMessageStats.user_id, UserMessageStats.unread_count
+                ).filter(UserMessageStats.user_id.in_(receiver_ids)))
+            finally:
+                self._end_read()
+
+            nodes = self.graph_manager.graph.nodes
+            for row in rows:
+                sender = nodes[row['sender_id']] if row['sender_id'] in nodes else {}
+                self.notifier.message_delivered(row['receiver_id'], {
+                    'id': row['id'],
+                    'sender_id': row['sender_id'],
+                    'sender_username': sender.get('username'),
+                    'encrypted_content': row['encrypted_content'],
+                    'sent_at': row['sent_at'].isoformat()
+                }, unread.get(row['receiver_id'], 0))
+        except Exception:
+            # Delivery is already durable; a failed push only delays the client
+            logger.exception("Failed to push message notifications")
+
+    def _end_read(self):
+        """End the read-only transaction so the next read sees fresh commits"""
+        if self.read_session is not self.db_session:
+            self.read_session.close()
+
+    def _message_rows(self):
+        """Query plain message rows with sender and receiver usernames joined in"""
+        sender = aliased(User)
+        receiver = aliased(User)
+        return self.read_session.query(
+            Message.id,
+            sender.username.label('sender_username'),
+            receiver.username.label('receiver_username'),
+            Message.encrypted_content,
+            Message.sent_at,
+            Message.read
+        ).outerjoin(sender, Message.sender_id == sender.id).outerjoin(
+            receiver, Message.receiver_id == receiver.id
+        )
+
+    def _page_size(self, limit: Optional[int]) -> int:
+        """Clamp a requested page size to the configured maximum"""
+        if not limit or limit < 1:
+            return self.page_size
+        return min(limit, self.max_page_size)
+
+    def _paginate(self, query, limit: Optional[int] = None,
+                  before: Optional[str] = None, after: Optional[str] = None) -> Dict:
+        """Fetch one window of a message query, keyed on (sent_at, id)
+
+        Without a cursor the most recent window is returned. Messages in the
+        window are always ordered oldest first.
+        """
+        limit = self._page_size(limit)
+
+        if self.retention_days:
+            cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+            query = query.filter(Message.sent_at >= cutoff)
+
+        if after is not None:
+            sent_at, message_id = decode_cursor(after)
+            query = query.filter(
+                (Message.sent_at > sent_at) |
+                ((Message.sent_at == sent_at) & (Message.id > message_id))
+            ).order_by(Message.sent_at, Message.id)
+        else:
+            if before is not None:
+                sent_at, message_id = decode_cursor(before)
+                query = query.filter(
+                    (Message.sent_at < sent_at) |
+                    ((Message.sent_at == sent_at) & (Message.id < message_id))
+                )
+            query = query.order_by(Message.sent_at.desc(), Message.id.desc())
 
-        messages_list = []
-        for msg in unread_messages:
-            sender = self.db_session.query(User).filter_by(id=msg.sender_id).first()
-            messages_list.append({
-                'id': msg.id,
-                'sender_username': sender.username,
-                'encrypted_content': msg.encrypted_content,
-                'sent_at': msg.sent_at.isoformat(),
-                'read': msg.read
-            })
-
-        return messages_list
-
-    def get_conversation_history(self, user1_id: int, user2_id: int) -> List[Dict]:
-        """Get conversation history between two users"""
-        messages = self.db_session.query(Message).filter(
-            ((Message.sender_id == user1_id) & (Message.receiver_id == user2_id)) |
-            ((Message.sender_id == user2_id) & (Message.receiver_id == user1_id))
-        ).order_by(Message.sent_at).all()
-
-        history = []
-        for msg in messages:
-            sender = self.db_session.query(User).filter_by(id=msg.sender_id).first()
-            receiver = self.db_session.query(User).filter_by(id=msg.receiver_id).first()
-            
-            history.append({
-                'id': msg.id,
-                'sender_username': sender.username,
-                'receiver_username': receiver.username,
-                'encrypted_content': msg.encrypted_content,
-                'sent_at': msg.sent_at.isoformat(),
-                'read': msg.read
-            })
-
-        return history
+        # Fetch one extra row to learn whether another window exists
+        try:
+            rows = query.limit(limit + 1).all()
+        finally:
+            self._end_read()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is None:
+            rows.reverse()
+
+        messages = [{
+            'id': row.id,
+            'sender_username': row.sender_username,
+            'receiver_username': row.receiver_username,
+            'encrypted_content': row.encrypted_content,
+            'sent_at': row.sent_at.isoformat(),
+            'read': row.read
+        } for row in rows]
+
+        return {
+            'messages': messages,
+            'before': encode_cursor(rows[0].sent_at, rows[0].id) if rows else before,
+            'after': encode_cursor(rows[-1].sent_at, rows[-1].id) if rows else after,
+            'has_older': has_more if after is None else True,
+            'has_newer': has_more if after is not None else before is not None
+        }
+
+    def get_unread_page(self, user_id: int, limit: Optional[int] = None,
+                        before: Optional[str] = None, after: Optional[str] = None) -> Dict:
+        """Get one window of a user's unread messages with cursors for the next"""
+        query = self._message_rows().filter(
+            Message.receiver_id == user_id,
+            Message.read == False
+        )
+        return self._paginate(query, limit=limit, before=before, after=after)
+
+    def get_unread_messages(self, user_id: int, limit: Optional[int] = None,
+                            before: Optional[str] = None, after: Optional[str] = None) -> List[Dict]:
+        """Get unread messages for a user, most recent window by default"""
+        return self.get_unread_page(user_id, limit=limit, before=before, after=after)['messages']
+
+    def get_conversation_page(self, user1_id: int, user2_id: Optional[int] = None,
+                              limit: Optional[int] = None, before: Optional[str] = None,
+                              after: Optional[str] = None) -> Dict:
+        """Get one window of a conversation with cursors for the next
+
+        Without user2_id, every message user1 sent or received is included.
+        """
+        if user2_id is None:
+            condition = (Message.sender_id == user1_id) | (Message.receiver_id == user1_id)
+        else:
+            condition = (
+                ((Message.sender_id == user1_id) & (Message.receiver_id == user2_id)) |
+                ((Message.sender_id == user2_id) & (Message.receiver_id == user1_id))
+            )
+        query = self._message_rows().filter(condition)
+        return self._paginate(query, limit=limit, before=before, after=after)
+
+    def get_conversation_history(self, user1_id: int, user2_id: Optional[int] = None,
+                                 limit: Optional[int] = None, before: Optional[str] = None,
+                                 after: Optional[str] = None) -> List[Dict]:
+        """Get conversation history between two users, most recent window by default"""
+        return self.get_conversation_page(user1_id, user2_id, limit=limit,
+                                          before=before, after=after)['messages']
 
     def mark_as_read(self, message_id: int) -> bool:
         """Mark a message as read"""
-        message = self.db_session.query(Message).filter_by(id=message_id).first()
-        if message:
-            message.read = True
-            self.db_session.commit()
-            return True
-        return False
+        message = self.db_session.query(Message.receiver_id).filter_by(id=message_id).first()
+        if not message:
+            return False
+
+        # Only the request that actually flips the flag adjusts the counter
+        flipped = self.db_session.query(Message).filter_by(
+            id=message_id, read=False
+        ).update({Message.read: True}, synchronize_session=False)
+        if flipped:
+            self._bump_counters(message.receiver_id, unread=-1)
+        self.db_session.commit()
+        return True
 
     def delete_message(self, message_id: int, user_id: int) -> bool:
         """Delete a message (only if user is sender or receiver)"""
         message = self.db_session.query(Message).filter_by(id=message_id).first()
         if message and (message.sender_id == user_id or message.receiver_id == user_id):
-            self.db_session.delete(message)
+            sender_id, receiver_id, was_unread = message.sender_id, message.receiver_id, not message.read
+            deleted = self.db_session.query(Message).filter_by(id=message_id).delete(
+                synchronize_session='fetch'
+            )
+            unread = -1 if was_unread else 0
+            if deleted and sender_id == receiver_id:
+                self._bump_counters(sender_id, sent=-1, received=-1, unread=unread)
+            elif deleted:
+                self._bump_counters(sender_id, sent=-1)
+                self._bump_counters(receiver_id, received=-1, unread=unread)
             self.db_session.commit()
             return True
         return False
 
     def get_user_messages_summary(self, user_id: int) -> Dict:
         """Get summary of user's messages"""
-        total_sent = self.db_session.query(Message).filter_by(sender_id=user_id).count()
-        total_received = self.db_session.query(Message).filter_by(receiver_id=user_id).count()
-        unread_count = self.db_session.query(Message).filter_by(
-            receiver_id=user_id,
-            read=False
-        ).count()
+        try:
+            stats = self.read_session.query(
+                UserMessageStats.sent_count,
+                UserMessageStats.received_count,
+                UserMessageStats.unread_count
+            ).filter_by(user_id=user_id).first()
+        finally:
+            self._end_read()
+
+        if stats is None:
+            stats = self._rebuild_counters(user_id)
+            self.db_session.commit()
 
         return {
-            'total_sent': total_sent,
-            'total_received': total_received,
-            'unread_count': unread_count
-        }
\ No newline at end of file
+            'total_sent': stats.sent_count,
+            'total_received': stats.received_count,
+            'unread_count': stats.unread_count
+        }
+
+    def _recounts(self, user_id) -> Dict:
+        """A user's counters as scalar subqueries over the messages table
+
+        user_id may be an id or a column to correlate with, e.g. in an UPDATE
+        of user_message_stats.
+        """
+        return {
+            'sent_count': select(func.count(Message.id)).where(
+                Message.sender_id == user_id).scalar_subquery(),
+            'received_count': select(func.count(Message.id)).where(
+                Message.receiver_id == user_id).scalar_subquery(),
+            'unread_count': select(func.count(Message.id)).where(
+                Message.receiver_id == user_id, Message.read == False).scalar_subquery()
+        }
+
+    def _insert_recounted(self, user_id: int, on_conflict: Optional[Dict] = None):
+        """Create a user's counters recounted from the messages table
+
+        If a concurrent transaction created the row first, the on_conflict
+        column values are set on it instead, or it is left alone when there
+        are none. Uses INSERT ... ON CONFLICT where the dialect has it, else
+        an INSERT in a savepoint with an UPDATE on IntegrityError.
+        """
+        stats = UserMessageStats.__table__
+        values = dict(self._recounts(user_id), user_id=user_id)
+        upsert_insert = UPSERT_INSERTS.get(self.db_session.get_bind().dialect.name)
+        if upsert_insert is not None:
+            stmt = upsert_insert(stats).values(**values)
+            if on_conflict:
+                stmt = stmt.on_conflict_do_update(index_elements=[stats.c.user_id], set_=on_conflict)
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=[stats.c.user_id])
+            self.db_session.execute(stmt)
+            return
+
+        try:
+            with self.db_session.begin_nested():
+                self.db_session.execute(insert(stats).values(**values))
+        except IntegrityError:
+            if on_conflict:
+                self.db_session.execute(
+                    update(stats).where(stats.c.user_id == user_id).values(**on_conflict))
+
+    def _bump_counters(self, user_id: int, sent: int = 0, received: int = 0, unread: int = 0):
+        """Adjust a user's message counters inside the current transaction"""
+        updated = self.db_session.query(UserMessageStats).filter_by(user_id=user_id).update({
+            UserMessageStats.sent_count: UserMessageStats.sent_count + sent,
+            UserMessageStats.received_count: UserMessageStats.received_count + received,
+            UserMessageStats.unread_count: UserMessageStats.unread_count + unread
+        }, synchronize_session=False)
+        if not updated:
+            self._seed_counters(user_id, sent, received, unread)
+
+    def _seed_counters(self, user_id: int, sent: int, received: int, unread: int):
+        """Create a user's counters on first activity, or apply the deltas if
+        a concurrent transaction just created them
+
+        The new row is recounted from the messages, which includes our own
+        (already flushed) change; a concurrent creator's recount can't see
+        our uncommitted messages, so on conflict our deltas are added.
+        """
+        stats = UserMessageStats.__table__
+        self._insert_recounted(user_id, on_conflict={
+            'sent_count': stats.c.sent_count + sent,
+            'received_count': stats.c.received_count + received,
+            'unread_count': stats.c.unread_count + unread
+        })
+
+    def _bump_counters_bulk(self, deltas: Dict[int, List[int]]):
+        """Apply {user_id: [sent, received, unread]} counter deltas in one statement"""
+        existing = {user_id for (user_id,) in self.db_session.query(
+            UserMessageStats.user_id
+        ).filter(UserMessageStats.user_id.in_(list(deltas)))}
+
+        stats = UserMessageStats.__table__
+        params = [
+            {'uid': user_id, 'd_sent': sent, 'd_received': received, 'd_unread': unread}
+            for user_id, (sent, received, unread) in deltas.items() if user_id in existing
+        ]
+        if params:
+            self.db_session.execute(
+                update(stats).where(stats.c.user_id == bindparam('uid')).values(
+                    sent_count=stats.c.sent_count + bindparam('d_sent'),
+                    received_count=stats.c.received_count + bindparam('d_received'),
+                    unread_count=stats.c.unread_count + bindparam('d_unread')
+                ),
+                params
+            )
+
+        for user_id, (sent, received, unread) in deltas.items():
+            if user_id not in existing:
+                self._seed_counters(user_id, sent, received, unread)
+
+    def _rebuild_counters(self, user_id: int):
+        """Recount a user's messages and store the result, without committing"""
+        self._insert_recounted(user_id, on_conflict=self._recounts(user_id))
+        return self.db_session.query(
+            UserMessageStats.sent_count,
+            UserMessageStats.received_count,
+            UserMessageStats.unread_count
+        ).filter_by(user_id=user_id).one()
+
+    def reconcile_counters(self) -> int:
+        """Rebuild every user's counters from the messages table
+
+        Each stored row is recounted in a single UPDATE, so sends and reads
+        committing meanwhile can't be overwritten with stale counts. Returns
+        the number of users whose stored counters had drifted.
+        """
+        stats = UserMessageStats.__table__
+        recounts = self._recounts(stats.c.user_id)
+        drifted = self.db_session.execute(
+            update(stats).where(or_(*(stats.c[column] != recount
+                                      for column, recount in recounts.items())))
+            .values(**recounts)
+        ).rowcount
+
+        active = union(
+            select(Message.sender_id.label('user_id')),
+            select(Message.receiver_id.label('user_id'))
+        ).subquery()
+        missing = self.db_session.execute(
+            select(active.c.user_id).where(active.c.user_id.is_not(None),
+                                           active.c.user_id.not_in(select(stats.c.user_id)))
+        ).scalars().all()
+        for user_id in missing:
+            # A send may have created the row since we looked; its counters
+            # are at least as current as ours
+            self._insert_recounted(user_id)
+            drifted += 1
+
+        self.db_session.commit()
+        return drifted
\ No newline at end of file
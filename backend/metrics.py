@@ -0,0 +1,169 @@
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Optional, Tuple
+from sqlalchemy import event
+import bisect
+import threading
+import time
+
+# Latency bucket upper bounds in seconds, as Prometheus clients default to,
+# with finer steps at the low end for cached lookups and crypto
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram:
+    """Bucketed observations of one metric for one label set"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # Buckets are inclusive upper bounds (le)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Counters and histograms, rendered in the Prometheus text format
+
+    Metrics are declared once with describe() and then updated with inc()
+    and observe(), keyed by their label values.
+    """
+
+    def __init__(self, namespace: str = 'scs'):
+        self.namespace = namespace
+        self._metrics = {}  # name -> (type, help, buckets)
+        self._values = {}  # name -> {sorted label items: value or Histogram}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, metric_type: str, help_text: str,
+                 buckets: Optional[Tuple[float, ...]] = None):
+        with self._lock:
+            self._metrics[name] = (metric_type, help_text, buckets or LATENCY_BUCKETS)
+            self._values.setdefault(name, {})
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._values[name].get(key)
+            if histogram is None:
+                histogram = self._values[name][key] = Histogram(self._metrics[name][2])
+            histogram.observe(value)
+
+    def reset(self):
+        """Drop every recorded value, keeping the declarations"""
+        with self._lock:
+            for values in self._values.values():
+                values.clear()
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text, _) in self._metrics.items():
+                full_name = f"{self.namespace}_{name}"
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                for key, value in sorted(self._values[name].items()):
+                    if metric_type == 'histogram':
+                        lines.extend(_histogram_lines(full_name, key, value))
+                    else:
+                        lines.append(f"{full_name}{_labels(key)} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+def _labels(key, **extra) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in items)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _histogram_lines(full_name: str, key, histogram: Histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        yield f"{full_name}_bucket{_labels(key, le=_number(bound))} {cumulative}"
+    yield f"{full_name}_bucket{_labels(key, le='+Inf')} {histogram.count}"
+    yield f"{full_name}_sum{_labels(key)} {_number(histogram.sum)}"
+    yield f"{full_name}_count{_labels(key)} {histogram.count}"
+
+# Process-wide registry; /metrics renders it
+registry = MetricsRegistry()
+
+OPERATION_SECONDS = 'operation_duration_seconds'
+OPERATION_ERRORS = 'operation_errors_total'
+DB_QUERIES = 'db_queries_total'
+REQUEST_SECONDS = 'http_request_duration_seconds'
+REQUEST_QUERIES = 'http_request_db_queries'
+
+registry.describe(OPERATION_SECONDS, 'histogram', 'Latency of instrumented backend operations')
+registry.describe(OPERATION_ERRORS, 'counter', 'Instrumented backend operations that raised')
+registry.describe(DB_QUERIES, 'counter', 'SQL statements executed')
+registry.describe(REQUEST_SECONDS, 'histogram', 'HTTP request latency by endpoint')
+registry.describe(REQUEST_QUERIES, 'histogram', 'SQL statements executed per HTTP request',
+                  buckets=QUERY_COUNT_BUCKETS)
+
+def timed(operation: str) -> Callable:
+    """Decorator recording a function's latency (and exceptions) under operation"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                registry.inc(OPERATION_ERRORS, operation=operation)
+                raise
+            finally:
+                registry.observe(OPERATION_SECONDS, time.perf_counter() - started,
+                                 operation=operation)
+        return wrapper
+    return decorator
+
+# Statement counter of the request running in this context, if any
+_request_queries: ContextVar[Optional[list]] = ContextVar('request_queries', default=None)
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    registry.inc(DB_QUERIES)
+    counter = _request_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+def instrument_engine(engine):
+    """Count every statement the engine executes"""
+    if not event.contains(engine, 'before_cursor_execute', _count_query):
+        event.listen(engine, 'before_cursor_execute', _count_query)
+
+def request_started() -> Tuple[float, list]:
+    """Start timing a request and counting its SQL statements
+
+    Pass the result to request_finished when the response is ready.
+    """
+    counter = [0]
+    _request_queries.set(counter)
+    return time.perf_counter(), counter
+
+def request_finished(state: Tuple[float, list], endpoint: str, method: str, status: int) -> int:
+    """Record a request's latency and statement count; returns the count"""
+    started, counter = state
+    _request_queries.set(None)
+    registry.observe(REQUEST_SECONDS, time.perf_counter() - started,
+                     endpoint=endpoint, method=method, status=status)
+    registry.observe(REQUEST_QUERIES, counter[0], endpoint=endpoint)
+    return counter[0]
@@ -0,0 +1,104 @@
+import networkx as nx
+from typing import Callable, Hashable, Tuple
+import threading
+
+class ComponentTracker:
+    """Connected components of the network, kept current under mutations
+
+    Additions merge components union-find style, relabelling the smaller
+    one. A removal may split a component, which only a traversal can tell,
+    so removals mark the tracker stale and the next read rebuilds it in one
+    linear pass over the graph.
+    """
+
+    def __init__(self, graph_manager):
+        self.graph_manager = graph_manager
+        self._component_of = {}  # node -> component label
+        self._members = {}  # component label -> set of nodes
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget everything; the next read rebuilds from the graph"""
+        with self._lock:
+            self._stale = True
+
+    def node_added(self, node: Hashable):
+        with self._lock:
+            if not self._stale and node not in self._component_of:
+                self._component_of[node] = node
+                self._members[node] = {node}
+
+    def edge_added(self, node1: Hashable, node2: Hashable):
+        with self._lock:
+            if self._stale:
+                return
+            for node in (node1, node2):
+                if node not in self._component_of:
+                    self._component_of[node] = node
+                    self._members[node] = {node}
+
+            first, second = self._component_of[node1], self._component_of[node2]
+            if first == second:
+                return
+            if len(self._members[first]) < len(self._members[second]):
+                first, second = second, first
+            for node in self._members[second]:
+                self._component_of[node] = first
+            self._members[first] |= self._members.pop(second)
+
+    def removed(self):
+        """A node or edge went away; components may have split"""
+        self.reset()
+
+    def _rebuild(self):
+        component_of = {}
+        members = {}
+        for component in nx.connected_components(self.graph_manager.graph):
+            label = next(iter(component))
+            members[label] = component
+            for node in component:
+                component_of[node] = label
+        self._component_of = component_of
+        self._members = members
+        self._stale = False
+
+    def count(self) -> int:
+        """Number of connected components"""
+        with self._lock:
+            if self._stale:
+                self._rebuild()
+            return len(self._members)
+
+def sweep_diameter_bounds(eccentricity: Callable[[Hashable], Tuple[int, Hashable]],
+                          start: Hashable, sweeps: int) -> Tuple[int, int]:
+    """Bound the diameter of a connected graph with repeated double sweeps
+
+    eccentricity(node) returns a node's eccentricity (in hops) and a node
+    at that distance. Each sweep jumps to the farthest node found so far:
+    every eccentricity is a lower bound on the diameter and twice any
+    eccentricity an upper bound. Runs at most sweeps BFS traversals and
+    stops early once the bounds meet.
+    """
+    lower, upper = 0, float('inf')
+    node = start
+    seen = set()
+    for _ in range(max(sweeps, 1)):
+        if node in seen:
+            break
+        seen.add(node)
+        distance, farthest = eccentricity(node)
+        lower = max(lower, distance)
+        upper = min(upper, 2 * distance)
+        if lower == upper:
+            break
+        node = farthest
+    return lower, upper
+
+def bfs_eccentricity(graph: nx.Graph) -> Callable[[Hashable], Tuple[int, Hashable]]:
+    """An eccentricity function for sweep_diameter_bounds over a networkx graph"""
+    def eccentricity(node):
+        lengths = nx.single_source_shortest_path_length(graph, node)
+        farthest = max(lengths, key=lengths.get)
+        return lengths[farthest], farthest
+    return eccentricity
@@ -0,0 +1,71 @@
+from flask import session
+from flask_socketio import join_room
+from .authentication import verify_token
+from .crypto_utils import encode_ciphertext
+from .database import User
+
+def user_room(node_id: int) -> str:
+    """Name of the SocketIO room a user's clients join"""
+    return f"user:{node_id}"
+
+# Admin clients watching the network view
+ADMIN_ROOM = 'admins'
+
+# Most graph changes pushed in a single event
+GRAPH_PUSH_LIMIT = 500
+
+class SocketIONotifier:
+    """Push committed messages and graph changes to SocketIO rooms"""
+
+    def __init__(self, socketio, db_session, graph_manager=None):
+        self.socketio = socketio
+        self.db_session = db_session
+        self.graph_manager = graph_manager
+
+    def register_handlers(self):
+        """Put every authenticated connection in its user's room, admins in the admin room"""
+        @self.socketio.on('connect')
+        def handle_connect(auth=None):
+            payload = verify_token(session.get('token')) if session.get('token') else None
+            if not payload:
+                return False
+
+            if payload.get('is_admin'):
+                join_room(ADMIN_ROOM)
+                return
+
+            user = self.db_session.get(User, payload['user_id'])
+            if user is None or user.node_id is None:
+                return False
+            join_room(user_room(user.node_id))
+
+        @self.socketio.on('graph_changes_since')
+        def handle_graph_changes_since(data=None):
+            payload = verify_token(session.get('token')) if session.get('token') else None
+            if not payload or not payload.get('is_admin') or self.graph_manager is None:
+                return {'error': 'Unauthorized'}
+            try:
+                since = int((data or {}).get('since'))
+            except (TypeError, ValueError):
+                return {'error': 'since is required'}
+            # The return value is sent back as the event's acknowledgement
+            return self.graph_manager.get_changes_since(since)
+
+    def message_delivered(self, receiver_id: int, envelope: dict, unread_count: int):
+        """Emit a new message and the receiver's unread count"""
+        self.socketio.emit('new_message', {
+            'message': dict(envelope, encrypted_content=encode_ciphertext(envelope['encrypted_content'])),
+            'unread_count': unread_count
+        }, to=user_room(receiver_id))
+
+    def graph_changed(self, changes: list):
+        """Emit committed topology changes to admin clients
+
+        Large batches are announced by version only; clients then page
+        through /api/network-changes instead of receiving one huge event.
+        """
+        if len(changes) > GRAPH_PUSH_LIMIT:
+            changes_event = {'version': changes[-1]['version'], 'changes': []}
+        else:
+            changes_event = {'version': changes[-1]['version'], 'changes': changes}
+        self.socketio.emit('graph_changes', changes_event, to=ADMIN_ROOM)
@@ -0,0 +1,223 @@
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+import asyncio
+import itertools
+import statistics
+import threading
+import time
+
+class RelayEnvelope:
+    """A message in flight, positioned at the head of its remaining path"""
+
+    def __init__(self, message_id: int, source: int, target: int,
+                 path: List[int], payload=None):
+        self.message_id = message_id
+        self.source = source
+        self.target = target
+        self.path = path  # path[0] is the node currently holding the message
+        self.payload = payload
+        self.visited = [source]
+        self.hop_latencies = []
+        self.reroutes = 0
+        self.created_at = time.monotonic()
+        self.arrived_at = self.created_at  # When it entered the current node's queue
+        self.future = None
+
+class RelayEngine:
+    """Forward messages hop by hop along NetworkGraph paths
+
+    Every node has its own queue and worker coroutine, created on first use.
+    A worker sends the head message over the next link (sleeping
+    link_latency seconds per unit of edge weight) into the neighbour's queue.
+    If that link has disappeared, the message is rerouted from where it is,
+    retrying up to max_retries times while no path exists. The engine runs
+    its event loop on a background thread; submit() is thread-safe.
+    """
+
+    def __init__(self, graph_manager, link_latency: float = 0.0, max_retries: int = 3,
+                 retry_delay: float = 0.05, delivery_timeout: float = 5.0,
+                 latency_samples: int = 100000):
+        self.graph_manager = graph_manager
+        self.link_latency = link_latency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.delivery_timeout = delivery_timeout
+
+        self.loop = None
+        self._thread = None
+        self._queues = {}
+        self._workers = {}
+        self._ids = itertools.count(1)
+
+        # Counters and bounded latency samples
+        self.delivered = 0
+        self.failed = 0
+        self.reroute_count = 0
+        self.retry_count = 0
+        self._hop_latencies = deque(maxlen=latency_samples)
+        self._latencies = deque(maxlen=latency_samples)
+        self._started_at = None
+
+    def start(self):
+        """Run the engine's event loop on a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='relay-engine', daemon=True)
+        self._thread.start()
+        self._started_at = time.monotonic()
+        return self
+
+    def stop(self):
+        """Cancel the node workers and stop the event loop"""
+        if self.loop is None:
+            return
+
+        async def cancel_workers():
+            for task in self._workers.values():
+                task.cancel()
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+            self._workers.clear()
+            self._queues.clear()
+
+        asyncio.run_coroutine_threadsafe(cancel_workers(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+        self._thread = None
+
+    def submit(self, source: int, target: int, payload=None,
+               path: Optional[List[int]] = None) -> Future:
+        """Inject a message from any thread; the Future resolves with its delivery report"""
+        if self.loop is None:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(self.relay(source, target, payload, path), self.loop)
+
+    async def relay(self, source: int, target: int, payload=None,
+                    path: Optional[List[int]] = None) -> Dict:
+        """Inject a message from inside the engine's loop and wait for its delivery report"""
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        if path is None:
+            path = self._route(source, target)
+        envelope = RelayEnvelope(next(self._ids), source, target, list(path or [source]), payload)
+        envelope.future = asyncio.get_running_loop().create_future()
+
+        if not path:
+            self._finish(envelope, "No valid path found between sender and receiver")
+        else:
+            self._queue_for(source).put_nowait(envelope)
+        return await envelope.future
+
+    def _route(self, source: int, target: int) -> Optional[List[int]]:
+        try:
+            return self.graph_manager.get_shortest_path(source, target, build_tree=False)
+        except Exception:
+            # Unknown node, or the graph changed under Dijkstra
+            return None
+
+    def _queue_for(self, node: int) -> asyncio.Queue:
+        queue = self._queues.get(node)
+        if queue is None:
+            queue = self._queues[node] = asyncio.Queue()
+            self._workers[node] = asyncio.get_running_loop().create_task(self._worker(node, queue))
+        return queue
+
+    async def _worker(self, node: int, queue: asyncio.Queue):
+        while True:
+            envelope = await queue.get()
+            try:
+                await self._forward(node, envelope)
+            except Exception as e:
+                self._finish(envelope, f"Relay error at node {node}: {str(e)}")
+
+    async def _forward(self, node: int, envelope: RelayEnvelope):
+        """Deliver the envelope here or move it one hop closer to its target"""
+        if node == envelope.target:
+            self._finish(envelope)
+            return
+
+        graph = self.graph_manager.graph
+        attempts = 0
+        while True:
+            if node not in graph:
+                self._finish(envelope, f"Node {node} left the network with the message")
+                return
+
+            next_hop = envelope.path[1] if len(envelope.path) > 1 else None
+            if next_hop is not None and graph.has_edge(node, next_hop):
+                break
+
+            # The planned link is gone; reroute from here
+            path = self._route(node, envelope.target)
+            if path and len(path) > 1:
+                envelope.path = path
+                envelope.reroutes += 1
+                self.reroute_count += 1
+                continue
+
+            attempts += 1
+            if attempts > self.max_retries:
+                self._finish(envelope, "No valid path found between sender and receiver")
+                return
+            self.retry_count += 1
+            await asyncio.sleep(self.retry_delay * attempts)
+
+        if self.link_latency:
+            weight = graph[node][next_hop].get('weight', 1)
+            await asyncio.sleep(self.link_latency * weight)
+
+        now = time.monotonic()
+        hop_latency = now - envelope.arrived_at
+        envelope.hop_latencies.append(hop_latency)
+        self._hop_latencies.append(hop_latency)
+        envelope.arrived_at = now
+        envelope.path = envelope.path[1:]
+        envelope.visited.append(next_hop)
+        self._queue_for(next_hop).put_nowait(envelope)
+
+    def _finish(self, envelope: RelayEnvelope, error: Optional[str] = None):
+        latency = time.monotonic() - envelope.created_at
+        if error is None:
+            self.delivered += 1
+            self._latencies.append(latency)
+        else:
+            self.failed += 1
+
+        if not envelope.future.done():
+            envelope.future.set_result({
+                'message_id': envelope.message_id,
+                'delivered': error is None,
+                'reason': error,
+                'path': envelope.visited,
+                'hop_latencies': envelope.hop_latencies,
+                'latency': latency,
+                'reroutes': envelope.reroutes
+            })
+
+    def stats(self) -> Dict:
+        """Get delivery counters, throughput and latency percentiles"""
+        def summarize(samples):
+            samples = sorted(samples)
+            if not samples:
+                return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0}
+            return {
+                'count': len(samples),
+                'mean': statistics.fmean(samples),
+                'p50': samples[len(samples) // 2],
+                'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            }
+
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'reroutes': self.reroute_count,
+            'retries': self.retry_count,
+            'active_nodes': len(self._workers),
+            'throughput': self.delivered / elapsed if elapsed else 0.0,
+            'hop_latency': summarize(self._hop_latencies),
+            'latency': summarize(self._latencies)
+        }
@@ -0,0 +1,138 @@
+from database import Message
+from crypto_utils import encode_ciphertext
+from sqlalchemy import delete, select
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import gzip
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+class RetentionPurger:
+    """Delete messages older than the retention period in small batches
+
+    Each batch selects the oldest expired messages through the sent_at
+    index, deletes them, optionally appends the rows actually deleted to a
+    gzip archive and adjusts the per-user counters for them in one short
+    transaction, then pauses so other writers can get the database lock in
+    between.
+    """
+
+    def __init__(self, message_handler, retention_days: int, batch_size: int = 500,
+                 pause: float = 0.05, archive_path: Optional[str] = None):
+        self.message_handler = message_handler
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.pause = pause
+        # Append-only archive; every batch is written as its own gzip member
+        self.archive_path = archive_path
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Make a running purge return after its current batch"""
+        self._stop.set()
+
+    def purge(self) -> int:
+        """Delete every currently expired message; returns how many were deleted"""
+        if not self.retention_days:
+            return 0
+
+        self._stop.clear()
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        purged = 0
+        while not self._stop.is_set():
+            deleted = self.purge_batch(cutoff)
+            purged += deleted
+            # A short batch usually means we're done, but it can also mean
+            # someone else deleted part of it; only an empty one is final
+            if not deleted:
+                break
+            self._stop.wait(self.pause)
+
+        if purged:
+            logger.info("Purged %d messages sent before %s", purged, cutoff.isoformat())
+        return purged
+
+    def purge_batch(self, cutoff: datetime) -> int:
+        """Archive and delete up to batch_size messages sent before cutoff"""
+        handler = self.message_handler
+        session = handler.db_session
+        try:
+            ids = session.execute(
+                select(Message.id)
+                .where(Message.sent_at < cutoff)
+                .order_by(Message.sent_at, Message.id)
+                .limit(self.batch_size)
+            ).scalars().all()
+            if not ids:
+                session.rollback()
+                return 0
+
+            # Counters and the archive must only reflect the rows this DELETE
+            # removed: a user or another worker's purger may delete some of
+            # the selected ones first
+            rows = self._delete(session, ids)
+
+            # Archive before committing: a failed commit means the rows are
+            # archived again next time, never that they are lost
+            if rows and self.archive_path:
+                self._archive(rows)
+
+            handler._bump_counters_bulk(self._counter_deltas(rows))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return len(rows)
+
+    def _delete(self, session, ids: List[int]):
+        """Delete the messages with the given ids; returns the deleted rows"""
+        columns = (Message.id, Message.sender_id, Message.receiver_id,
+                   Message.encrypted_content, Message.sent_at, Message.read)
+        if session.get_bind().dialect.delete_returning:
+            return session.execute(
+                delete(Message).where(Message.id.in_(ids)).returning(*columns),
+                execution_options={'synchronize_session': False}
+            ).all()
+
+        # Without RETURNING, lock the rows so nobody else deletes them
+        # between our SELECT and DELETE
+        rows = session.execute(
+            select(*columns).where(Message.id.in_(ids)).with_for_update()
+        ).all()
+        session.execute(
+            delete(Message).where(Message.id.in_([row.id for row in rows])),
+            execution_options={'synchronize_session': False}
+        )
+        return rows
+
+    def _counter_deltas(self, rows) -> Dict[int, List[int]]:
+        deltas = {}
+        for row in rows:
+            if row.sender_id is not None:
+                deltas.setdefault(row.sender_id, [0, 0, 0])[0] -= 1
+            if row.receiver_id is not None:
+                receiver = deltas.setdefault(row.receiver_id, [0, 0, 0])
+                receiver[1] -= 1
+                if not row.read:
+                    receiver[2] -= 1
+        return deltas
+
+    def _archive(self, rows):
+        """Append rows as JSON lines to the gzip archive and flush them to disk"""
+        lines = ''.join(json.dumps({
+            'id': row.id,
+            'sender_id': row.sender_id,
+            'receiver_id': row.receiver_id,
+            'encrypted_content': encode_ciphertext(row.encrypted_content) if row.encrypted_content else None,
+            'sent_at': row.sent_at.isoformat() if row.sent_at else None,
+            'read': row.read
+        }) + '\n' for row in rows)
+
+        with open(self.archive_path, 'ab') as archive:
+            archive.write(gzip.compress(lines.encode()))
+            archive.flush()
+            os.fsync(archive.fileno())
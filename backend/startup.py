@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+from typing import Dict
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """Record how long each phase of application startup takes
+
+    Phases are timed with phase() as a context manager, or added from a
+    duration measured before the timer existed (e.g. module imports);
+    report() gives them in order with the total, which counts both.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []  # (name, seconds)
+        self._before_start = 0.0
+
+    def add(self, name: str, seconds: float):
+        """Record a phase that ran before the timer was created"""
+        self.phases.append((name, seconds))
+        self._before_start += seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self) -> Dict:
+        """Phase durations and the total, in milliseconds"""
+        return {
+            'total_ms': round((time.perf_counter() - self.started + self._before_start) * 1000, 1),
+            'phases': [{'name': name, 'ms': round(seconds * 1000, 1)}
+                       for name, seconds in self.phases]
+        }
+
+    def log(self) -> Dict:
+        """Log the report, slowest phases first, and return it"""
+        report = self.report()
+        phases = sorted(report['phases'], key=lambda phase: phase['ms'], reverse=True)
+        logger.info("Startup took %.1f ms: %s", report['total_ms'],
+                    ', '.join(f"{phase['name']} {phase['ms']:.1f} ms" for phase in phases))
+        return report
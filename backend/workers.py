@@ -0,0 +1,46 @@
+from typing import Callable, Optional
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class PeriodicWorker:
+    """Run a maintenance job on a daemon thread every `interval` seconds"""
+
+    def __init__(self, name: str, interval: float, job: Callable,
+                 teardown: Optional[Callable] = None):
+        self.name = name
+        self.interval = interval
+        self.job = job
+        # Called after every run, e.g. to release the thread's DB session
+        self.teardown = teardown
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the worker thread if it isn't already running"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """Ask the worker to stop and wait for the current run to finish"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run_once(self):
+        """Run the job a single time in the calling thread"""
+        try:
+            return self.job()
+        except Exception:
+            logger.exception("%s run failed", self.name)
+        finally:
+            if self.teardown:
+                self.teardown()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
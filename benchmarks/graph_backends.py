@@ -0,0 +1,82 @@
+"""Compare memory and path query time of the networkx and CSR graph backends
+
+Usage: python benchmarks/graph_backends.py [--nodes 100000] [--degree 10]
+       [--queries 50]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from graph_utils import NetworkGraph
+from csr_graph import CSRNetworkGraph
+
+def random_topology(node_count, degree, rng):
+    """A ring (so the graph is connected) plus random chords, as id arrays"""
+    nodes = np.arange(1, node_count + 1, dtype=np.int64)
+    chords = node_count * (degree - 2) // 2
+    u = np.concatenate([nodes, rng.integers(1, node_count + 1, chords)])
+    v = np.concatenate([np.roll(nodes, -1), rng.integers(1, node_count + 1, chords)])
+    weights = rng.integers(1, 4, len(u))
+    loops = u != v
+    return nodes, u[loops], v[loops], weights[loops]
+
+def build_networkx(nodes, u, v, weights):
+    network = NetworkGraph(None)
+    network.graph.add_nodes_from((node, {'username': f'user{node}'}) for node in nodes.tolist())
+    network.graph.add_weighted_edges_from(zip(u.tolist(), v.tolist(), weights.tolist()))
+    network._topology_changed()
+    return network
+
+def build_csr(nodes, u, v, weights):
+    network = CSRNetworkGraph(None)
+    network._build(nodes, [f'user{node}' for node in nodes.tolist()], u, v, weights)
+    network._topology_changed()
+    return network
+
+def measure(label, build, topology, pairs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    network = build(*topology)
+    built = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # A cold route (one full single-source search per sender, as
+    # send_message does) and a one-off pair lookup (as relay reroutes do)
+    timings = []
+    for build_tree in (True, False):
+        network._topology_changed()
+        start = time.perf_counter()
+        for source, target in pairs:
+            network.get_shortest_path(source, target, build_tree=build_tree)
+        timings.append((time.perf_counter() - start) / len(pairs) * 1000)
+
+    print(f"{label:>9}: {memory / 2 ** 20:8.1f} MiB  build {built:6.2f}s  "
+          f"route {timings[0]:8.2f} ms  pair {timings[1]:8.2f} ms")
+    return network
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--degree', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    topology = random_topology(args.nodes, args.degree, rng)
+    pick = random.Random(42)
+    pairs = [(pick.randint(1, args.nodes), pick.randint(1, args.nodes)) for _ in range(args.queries)]
+    print(f"{args.nodes} nodes, {len(topology[1])} edges")
+
+    measure('networkx', build_networkx, topology, pairs)
+    measure('csr', build_csr, topology, pairs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Time the MessageHandler read/delete queries with and without indexes
+
+Usage: python benchmarks/message_queries.py [--messages 1000000] [--users 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from sqlalchemy import insert
+from database import Base, Message, NetworkEdge, User, init_db, migrate_db
+import database
+from message_handler import MessageHandler
+
+def populate(session, message_count, user_count):
+    """Insert users, a sparse edge set and message_count random messages"""
+    session.execute(insert(User), [
+        {'id': i, 'username': f'user{i}', 'password': 'x', 'node_id': i}
+        for i in range(1, user_count + 1)
+    ])
+    session.execute(insert(NetworkEdge), [
+        {'node1_id': i, 'node2_id': i + 1, 'weight': 1} for i in range(1, user_count)
+    ])
+
+    rng = random.Random(42)
+    start = datetime.utcnow() - timedelta(days=30)
+    batch = []
+    for i in range(message_count):
+        sender = rng.randint(1, user_count)
+        receiver = rng.randint(1, user_count)
+        batch.append({
+            'sender_id': sender,
+            'receiver_id': receiver,
+            'encrypted_content': b'x' * 100,
+            'sent_at': start + timedelta(seconds=i),
+            'read': rng.random() < 0.8
+        })
+        if len(batch) == 50000:
+            session.execute(insert(Message), batch)
+            batch = []
+    if batch:
+        session.execute(insert(Message), batch)
+    session.commit()
+
+def time_queries(handler, session, user_count, repeat):
+    """Run each query shape repeat times against random users"""
+    rng = random.Random(7)
+    users = [rng.randint(1, user_count) for _ in range(repeat)]
+    queries = {
+        'unread count': lambda u: session.query(Message).filter_by(receiver_id=u, read=False).count(),
+        'sent count': lambda u: session.query(Message).filter_by(sender_id=u).count(),
+        'unread page': lambda u: handler.get_unread_page(u),
+        'conversation page': lambda u: handler.get_conversation_page(u, u % user_count + 1),
+        'user history page': lambda u: handler.get_conversation_page(u),
+        'edge lookup': lambda u: session.query(NetworkEdge).filter(
+            (NetworkEdge.node1_id == u) | (NetworkEdge.node2_id == u)).all(),
+    }
+
+    results = {}
+    for name, query in queries.items():
+        start = time.perf_counter()
+        for user in users:
+            query(user)
+        results[name] = (time.perf_counter() - start) / repeat * 1000
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        session = init_db({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}"})
+        engine = database.engine
+
+        # Start from the old schema: tables only, no secondary indexes
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(bind=engine, checkfirst=True)
+
+        print(f"Populating {args.messages} messages for {args.users} users...")
+        populate(session, args.messages, args.users)
+        handler = MessageHandler(session, None)
+
+        before = time_queries(handler, session, args.users, args.repeat)
+        migrate_db(engine)
+        session.execute(database.text('ANALYZE'))
+        after = time_queries(handler, session, args.users, args.repeat)
+
+        print(f"{'query':<20}{'before (ms)':>14}{'after (ms)':>14}")
+        for name in before:
+            print(f"{name:<20}{before[name]:>14.2f}{after[name]:>14.2f}")
+
+if __name__ == '__main__':
+    main()
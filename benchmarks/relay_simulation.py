@@ -0,0 +1,99 @@
+"""Simulate hop-by-hop relaying over a large in-memory network under churn
+
+Usage: python benchmarks/relay_simulation.py [--nodes 2000] [--messages 5000]
+       [--churn 20] [--link-latency 0.0005]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from graph_utils import NetworkGraph
+from relay import RelayEngine
+
+def build_network(node_count, extra_edges, rng):
+    """A ring (so the graph starts connected) plus random chords"""
+    network = NetworkGraph(None)
+    graph = network.graph
+    for node in range(node_count):
+        graph.add_node(node, username=f'node{node}')
+    for node in range(node_count):
+        graph.add_edge(node, (node + 1) % node_count, weight=1)
+    for _ in range(extra_edges):
+        a, b = rng.randrange(node_count), rng.randrange(node_count)
+        if a != b:
+            graph.add_edge(a, b, weight=rng.randint(1, 3))
+    network._topology_changed()
+    return network
+
+async def churn(network, rate, rng, stop):
+    """Remove a random edge and add a random one, rate times per second"""
+    removed = added = 0
+    nodes = list(network.graph.nodes)
+    while not stop.is_set():
+        edges = list(network.graph.edges)
+        if edges:
+            network.remove_edge(*rng.choice(edges))
+            removed += 1
+        a, b = rng.choice(nodes), rng.choice(nodes)
+        if a != b:
+            network.add_edge(a, b, weight=rng.randint(1, 3))
+            added += 1
+        await asyncio.sleep(1 / rate)
+    return removed, added
+
+async def simulate(engine, network, args, rng):
+    stop = asyncio.Event()
+    churner = asyncio.create_task(churn(network, args.churn, rng, stop)) if args.churn else None
+
+    nodes = list(network.graph.nodes)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def send():
+        async with semaphore:
+            return await engine.relay(rng.choice(nodes), rng.choice(nodes))
+
+    start = time.perf_counter()
+    reports = await asyncio.gather(*(send() for _ in range(args.messages)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    churned = await churner if churner else (0, 0)
+    return reports, elapsed, churned
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=2000)
+    parser.add_argument('--extra-edges', type=int, default=4000)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--churn', type=float, default=20, help='edge swaps per second')
+    parser.add_argument('--link-latency', type=float, default=0.0005)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    network = build_network(args.nodes, args.extra_edges, rng)
+    engine = RelayEngine(network, link_latency=args.link_latency, retry_delay=0.01)
+
+    reports, elapsed, (removed, added) = asyncio.run(simulate(engine, network, args, rng))
+    stats = engine.stats()
+    hops = [len(report['path']) - 1 for report in reports if report['delivered']]
+
+    print(f"nodes={args.nodes} edges={network.graph.number_of_edges()} "
+          f"messages={args.messages} churn: -{removed}/+{added} edges")
+    print(f"delivered={stats['delivered']} failed={stats['failed']} "
+          f"reroutes={stats['reroutes']} retries={stats['retries']}")
+    print(f"throughput={args.messages / elapsed:.0f} msg/s over {elapsed:.2f}s, "
+          f"mean hops={sum(hops) / max(len(hops), 1):.2f}")
+    for name in ('latency', 'hop_latency'):
+        summary = stats[name]
+        print(f"{name:<12} mean={summary['mean'] * 1000:.2f}ms "
+              f"p50={summary['p50'] * 1000:.2f}ms p99={summary['p99'] * 1000:.2f}ms")
+
+if __name__ == '__main__':
+    main()
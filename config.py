@@ -10,6 +10,19 @@ class Config:
     # Database configuration
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///secure_comm.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    SQLALCHEMY_POOL_TIMEOUT = 30  # Seconds to wait for a free connection
+    SQLALCHEMY_POOL_RECYCLE = 1800  # Seconds before a pooled connection is replaced
+
+    # SQLite profile, applied to every new connection (None leaves the default)
+    SQLITE_JOURNAL_MODE = 'WAL'  # Readers don't block the writer
+    SQLITE_SYNCHRONOUS = 'NORMAL'  # Safe with WAL; fsync at checkpoints only
+    SQLITE_CACHE_SIZE = -65536  # Page cache per connection; negative means KiB
+    SQLITE_MMAP_SIZE = 268435456  # Bytes of the file to memory-map
+    SQLITE_BUSY_TIMEOUT = 5000  # Milliseconds to wait on a locked database
+    SQLITE_READ_POOL = True  # Separate read-only pool for history/dashboard reads
+    SQLITE_READ_POOL_SIZE = 10
     
     # Session configuration
     PERMANENT_SESSION_LIFETIME = timedelta(hours=24)
@@ -27,14 +40,57 @@ class Config:
     PASSWORD_SALT = os.environ.get('PASSWORD_SALT') or 'your-salt-here'
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'your-jwt-secret-here'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
+    # Root of the per-user message keys; required outside development/testing,
+    # where an unset key means a random one that doesn't survive a restart
+    ENCRYPTION_MASTER_KEY = os.environ.get('ENCRYPTION_MASTER_KEY')
+    MESSAGE_CIPHER = 'aes-gcm'  # 'aes-gcm', 'chacha20-poly1305' or 'fernet'; all of them decrypt
+    MESSAGE_KEY_CACHE_SIZE = 1024  # Recipients whose ready ciphers are kept in memory
+    BCRYPT_ROUNDS = 12  # bcrypt cost factor for new password hashes
+    AUTH_WORKERS = 4  # Threads running bcrypt
+    AUTH_MAX_PENDING = 32  # Queued + running hashes before logins fail fast
+    AUTH_TIMEOUT = 10.0  # Seconds a request waits for its hash
+    TOKEN_CACHE_SIZE = 1024  # Verified JWT payloads kept in memory
     
     # Network configuration
     MAX_NODES = 100
+    GRAPH_BACKEND = 'networkx'  # 'csr' keeps the topology in SciPy sparse arrays (large networks)
     MAX_CONNECTIONS_PER_NODE = 10
+    ROUTE_CACHE_SIZE = 512  # Cached single-source shortest-path trees
+    CENTRALITY_SAMPLE_THRESHOLD = 1000  # Approximate betweenness above this many nodes
+    CENTRALITY_SAMPLE_SIZE = 256  # Pivot nodes used for approximate betweenness
+    CENTRALITY_BACKGROUND = False  # Recompute centralities in a worker thread
+    NETWORK_DIAMETER_EXACT_LIMIT = 1000  # Larger graphs get a double-sweep diameter estimate
+    NETWORK_DIAMETER_SWEEPS = 4  # BFS traversals per diameter estimate
+    PATH_ENUM_MAX_PATHS = 100  # Paths returned by get_all_paths
+    PATH_ENUM_MAX_HOPS = None  # Longest path (in edges) get_all_paths considers
+    PATH_ENUM_TIMEOUT = 2.0  # Seconds get_all_paths may spend enumerating
+    GRAPH_CHANGE_LOG_SIZE = 10000  # Topology changes kept for incremental sync
+    GRAPH_SYNC_INTERVAL = 2  # Seconds between polls for other workers' changes (0 disables)
     
     # Message configuration
     MAX_MESSAGE_LENGTH = 1000
     MESSAGE_RETENTION_DAYS = 30
+    RETENTION_PURGE_INTERVAL = 3600  # Seconds between purges of expired messages (0 disables)
+    RETENTION_BATCH_SIZE = 500  # Messages deleted per transaction
+    RETENTION_BATCH_PAUSE = 0.05  # Seconds between batches, so writers get the lock
+    RETENTION_ARCHIVE_PATH = os.environ.get('RETENTION_ARCHIVE_PATH')  # gzip JSON-lines archive (None skips it)
+    MESSAGE_PAGE_SIZE = 50  # Messages per history window
+    MAX_MESSAGE_PAGE_SIZE = 200  # Largest window a client may request
+    RELAY_ENABLED = False  # Forward messages hop by hop before storing them
+    RELAY_LINK_LATENCY = 0.0  # Simulated seconds per unit of edge weight
+    RELAY_MAX_RETRIES = 3  # Reroute attempts while no path exists
+    RELAY_RETRY_DELAY = 0.05  # Seconds between reroute attempts (linear backoff)
+    RELAY_TIMEOUT = 5.0  # Seconds send_message waits for delivery
+    INGEST_QUEUE_ENABLED = False  # Group-commit messages from a write-behind queue
+    INGEST_QUEUE_SIZE = 10000  # Messages accepted but not yet written
+    INGEST_BATCH_SIZE = 500  # Messages per commit
+    INGEST_MAX_DELAY = 0.01  # Seconds a batch may wait to fill up
+    INGEST_PUT_TIMEOUT = 1.0  # Seconds a sender waits on a full queue
+    INGEST_ACK_TIMEOUT = 5.0  # Seconds a sender waits for its batch to commit
+    COUNTER_RECONCILE_INTERVAL = 3600  # Seconds between message counter rebuilds (0 disables)
+    METRICS_ENABLED = True  # Serve Prometheus-format metrics on /metrics
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # If set, scrapers must send it as a Bearer token
+    SQL_COUNT_HEADER = False  # Add an X-SQL-Query-Count header to every response
     
     # Demo data configuration
     CREATE_DEMO_DATA = True
@@ -42,6 +98,7 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    SQL_COUNT_HEADER = True
     SESSION_COOKIE_SECURE = False
     WTF_CSRF_ENABLED = False
 
@@ -62,6 +119,10 @@ class ProductionConfig(Config):
     SECRET_KEY = os.environ.get('SECRET_KEY')
     PASSWORD_SALT = os.environ.get('PASSWORD_SALT')
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
+    ENCRYPTION_MASTER_KEY = os.environ.get('ENCRYPTION_MASTER_KEY')
+
+    # /metrics is only served with a scrape token
+    METRICS_ENABLED = bool(os.environ.get('METRICS_TOKEN'))
 
 # Configuration dictionary
 config = {
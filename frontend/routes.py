@@ -1,9 +1,47 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
-from backend.authentication import login_required, admin_required
+from flask import Blueprint, Response, abort, g, render_template, request, redirect, url_for, flash, jsonify, session, current_app, stream_with_context
+from backend.authentication import login_required, admin_required, token_cache
+from backend.crypto_utils import AuthOverloadedError, encode_ciphertext
+from backend.graph_io import GRAPH_FORMATS, format_for, read_graph, write_graph
+from backend.metrics import CONTENT_TYPE, registry, request_started, request_finished
 from backend.authentication import auth_manager, graph_manager, message_handler
+import hmac
 
 routes = Blueprint('routes', __name__)
 
+# Time every request the app serves and count its SQL statements
+@routes.before_app_request
+def start_request_metrics():
+    g.request_metrics = request_started()
+
+@routes.after_app_request
+def tag_request_metrics(response):
+    state = g.get('request_metrics')
+    if state is not None:
+        g.response_status = response.status_code
+        if current_app.config.get('SQL_COUNT_HEADER', False):
+            response.headers['X-SQL-Query-Count'] = str(state[1][0])
+    return response
+
+# Recorded on teardown, which (unlike after_request) also runs when the
+# request raised
+@routes.teardown_app_request
+def finish_request_metrics(exception=None):
+    state = g.pop('request_metrics', None)
+    if state is not None:
+        status = 500 if exception is not None else g.pop('response_status', 500)
+        request_finished(state, request.endpoint or 'unmatched', request.method, status)
+
+@routes.route('/metrics')
+def metrics():
+    if not current_app.config.get('METRICS_ENABLED', True):
+        abort(404)
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode()):
+            abort(401)
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
 @routes.route('/')
 def index():
     return render_template('login.html')
@@ -14,15 +52,22 @@ def login():
     username = request.form.get('username')
     password = request.form.get('password')
     
+    try:
+        if role == 'admin':
+            token = auth_manager.authenticate_admin(username, password)
+        else:
+            token = auth_manager.authenticate_user(username, password)
+    except AuthOverloadedError:
+        flash('Server busy, please try again')
+        return redirect(url_for('routes.index'))
+
     if role == 'admin':
-        token = auth_manager.authenticate_admin(username, password)
         if token:
             session['token'] = token
             session['role'] = 'admin'
             session['username'] = username
             return redirect(url_for('routes.admin_dashboard'))
     else:
-        token = auth_manager.authenticate_user(username, password)
         if token:
             session['token'] = token
             session['role'] = 'user'
@@ -34,9 +79,17 @@ def login():
 
 @routes.route('/logout')
 def logout():
+    if session.get('token'):
+        token_cache.invalidate(session['token'])
     session.clear()
     return redirect(url_for('routes.index'))
 
+def _client_messages(messages):
+    """Ciphertext is stored as raw bytes; clients get it as base64 text"""
+    return [dict(msg, encrypted_content=encode_ciphertext(msg['encrypted_content']))
+            if msg.get('encrypted_content') is not None else msg
+            for msg in messages]
+
 # Admin routes
 @routes.route('/admin/dashboard')
 @admin_required
@@ -58,12 +111,81 @@ def add_admin():
 @routes.route('/admin/network')
 @admin_required
 def network_view():
-    graph_data = graph_manager.visualize_graph()
+    # The graph itself is drawn client-side from /api/network-data
     nodes = graph_manager.get_all_nodes()
     return render_template('admin/network.html', 
-                         graph_data=graph_data, 
                          nodes=nodes)
 
+@routes.route('/admin/network/image')
+@admin_required
+def network_image():
+    # Rendered once per graph version, then served from cache
+    graph_data = graph_manager.visualize_graph()
+    return jsonify({'image': graph_data, 'version': graph_manager.version})
+
+@routes.route('/api/network-data')
+@admin_required
+def network_data():
+    data, etag = graph_manager.get_graph_data()
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@routes.route('/admin/network/changes', methods=['POST'])
+@admin_required
+def apply_network_changes():
+    data = request.get_json(silent=True) or {}
+    changes = data.get('changes')
+    if not isinstance(changes, list) or not all(isinstance(change, dict) for change in changes):
+        return jsonify({'success': False, 'message': 'changes must be a list of objects'}), 400
+    try:
+        count = graph_manager.apply_changes(changes)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'applied': count, 'version': graph_manager.log_version})
+
+@routes.route('/admin/network/import', methods=['POST'])
+@admin_required
+def import_network():
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({'success': False, 'message': 'No file uploaded'}), 400
+    graph_format = request.form.get('format') or format_for(upload.filename)
+    if graph_format not in GRAPH_FORMATS:
+        return jsonify({'success': False, 'message': 'Unsupported graph format'}), 400
+    try:
+        # One transaction for the whole file
+        count = graph_manager.apply_changes(read_graph(upload.stream, graph_format))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'applied': count, 'version': graph_manager.log_version})
+
+@routes.route('/admin/network/export')
+@admin_required
+def export_network():
+    graph_format = request.args.get('format', 'csv')
+    if graph_format not in GRAPH_FORMATS:
+        return jsonify({'success': False, 'message': 'Unsupported graph format'}), 400
+    content_type, extension = GRAPH_FORMATS[graph_format]
+    return Response(stream_with_context(write_graph(graph_manager, graph_format)),
+                    mimetype=content_type,
+                    headers={'Content-Disposition': f'attachment; filename=network.{extension}'})
+
+@routes.route('/api/network-changes')
+@admin_required
+def network_changes():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'error': 'since is required'}), 400
+    limit = min(request.args.get('limit', 1000, type=int), 1000)
+    return jsonify(graph_manager.get_changes_since(since, limit=limit))
+
+@routes.route('/admin/api/token-cache')
+@admin_required
+def token_cache_stats():
+    return jsonify(token_cache.stats())
+
 @routes.route('/admin/users')
 @admin_required
 def manage_users():
@@ -85,11 +207,15 @@ def user_dashboard():
 @login_required
 def messages():
     user_id = auth_manager.get_user_id_from_token(session['token'])
-    conversations = message_handler.get_conversation_history(user_id)
-    unread = message_handler.get_unread_messages(user_id)
+    # Only the most recent window is rendered; older ones come from /api/messages
+    page_size = current_app.config.get('MESSAGE_PAGE_SIZE', 50)
+    conversations = message_handler.get_conversation_page(user_id, limit=page_size)
+    unread = message_handler.get_unread_messages(user_id, limit=page_size)
     return render_template('user/messages.html', 
-                         conversations=conversations, 
-                         unread=unread)
+                         conversations=_client_messages(conversations['messages']), 
+                         older_cursor=conversations['before'],
+                         has_older=conversations['has_older'],
+                         unread=_client_messages(unread))
 
 @routes.route('/user/send_message', methods=['POST'])
 @login_required
@@ -100,6 +226,21 @@ def send_message():
     success, msg = message_handler.send_message(user_id, receiver_id, message)
     return jsonify({'success': success, 'message': msg})
 
+@routes.route('/user/send_message_bulk', methods=['POST'])
+@login_required
+def send_message_bulk():
+    user_id = auth_manager.get_user_id_from_token(session['token'])
+    data = request.get_json(silent=True) or {}
+    receiver_ids = data.get('receiver_ids') or request.form.getlist('receiver_ids')
+    message = data.get('message') or request.form.get('message')
+    try:
+        receiver_ids = [int(receiver_id) for receiver_id in receiver_ids]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid receiver ids'}), 400
+
+    success, msg, failed = message_handler.send_messages_bulk(user_id, receiver_ids, message)
+    return jsonify({'success': success, 'message': msg, 'failed': failed})
+
 # API endpoints for AJAX calls
 @routes.route('/api/update_password', methods=['POST'])
 @login_required
@@ -109,6 +250,23 @@ def update_password():
     success = auth_manager.update_user_password(user_id, new_password)
     return jsonify({'success': success})
 
+@routes.route('/api/messages')
+@login_required
+def message_window():
+    user_id = auth_manager.get_user_id_from_token(session['token'])
+    other_id = request.args.get('with', type=int)
+    try:
+        page = message_handler.get_conversation_page(
+            user_id, other_id,
+            limit=request.args.get('limit', type=int),
+            before=request.args.get('before'),
+            after=request.args.get('after')
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    return jsonify({'success': True, **dict(page, messages=_client_messages(page['messages']))})
+
 @routes.route('/api/mark_message_read', methods=['POST'])
 @login_required
 def mark_message_read():
@@ -7,9 +7,72 @@ class NetworkGraph {
             .attr('width', '100%')
             .attr('height', '600px');
         this.simulation = null;
+        this.data = null;
+        this.logVersion = 0;
+    }
+
+    load() {
+        return fetch('/api/network-data')
+            .then(response => response.json())
+            .then(data => {
+                this.logVersion = data.log_version;
+                this.drawGraph(data);
+            });
+    }
+
+    // Fetch and apply everything after our version; reload on a reset
+    catchUp() {
+        return fetch(`/api/network-changes?since=${this.logVersion}`)
+            .then(response => response.json())
+            .then(feed => {
+                if (feed.reset) return this.load();
+                this.applyChanges(feed.changes);
+                if (feed.has_more) return this.catchUp();
+            });
+    }
+
+    // Apply graph change log entries in order and redraw once
+    applyChanges(changes) {
+        if (!this.data || !changes.length) return;
+        const endpoint = end => (typeof end === 'object' ? end.id : end);
+        const isEdge = (link, a, b) => {
+            const source = endpoint(link.source);
+            const target = endpoint(link.target);
+            return (source === a && target === b) || (source === b && target === a);
+        };
+
+        for (const change of changes) {
+            if (change.version <= this.logVersion) continue;
+            if (change.version !== this.logVersion + 1) {
+                // Missed something; resync from the log instead
+                this.catchUp();
+                return;
+            }
+            const { op, node1_id: a, node2_id: b } = change;
+            if (op === 'add_node') {
+                const node = this.data.nodes.find(n => n.id === a);
+                if (node) node.username = change.username;
+                else this.data.nodes.push({ id: a, username: change.username });
+            } else if (op === 'remove_node') {
+                this.data.nodes = this.data.nodes.filter(n => n.id !== a);
+                this.data.links = this.data.links.filter(
+                    l => endpoint(l.source) !== a && endpoint(l.target) !== a
+                );
+            } else if (op === 'add_edge') {
+                const link = this.data.links.find(l => isEdge(l, a, b));
+                if (link) link.weight = change.weight;
+                else this.data.links.push({ source: a, target: b, weight: change.weight });
+            } else if (op === 'remove_edge') {
+                this.data.links = this.data.links.filter(l => !isEdge(l, a, b));
+            }
+            this.logVersion = change.version;
+        }
+        // Existing node objects keep their positions across the redraw
+        this.drawGraph(this.data);
     }
 
     drawGraph(data) {
+        this.data = data;
         const width = this.container.clientWidth;
         const height = 600;
 
@@ -129,6 +192,7 @@ class NotificationManager {
     }
 
     updateBadge(count) {
+        if (!this.badge) return;
         if (count > 0) {
             this.badge.textContent = count;
             this.badge.classList.remove('hidden');
@@ -138,18 +202,29 @@ class NotificationManager {
     }
 
     addNotification(message) {
+        if (!this.container) return;
         const notification = document.createElement('div');
         notification.className = 'notification-item fade-in';
-        notification.innerHTML = `
-            <div class="flex items-center p-4 bg-white shadow rounded-lg mb-2">
-                <div class="flex-1">
-                    <p class="text-sm text-gray-600">${message}</p>
-                </div>
-                <button class="ml-2 text-gray-400 hover:text-gray-600">
-                    <i class="fas fa-times"></i>
-                </button>
-            </div>
-        `;
+        // Built from nodes: the text can contain user-chosen names
+        const row = document.createElement('div');
+        row.className = 'flex items-center p-4 bg-white shadow rounded-lg mb-2';
+
+        const body = document.createElement('div');
+        body.className = 'flex-1';
+        const text = document.createElement('p');
+        text.className = 'text-sm text-gray-600';
+        text.textContent = message;
+        body.append(text);
+
+        const close = document.createElement('button');
+        close.className = 'ml-2 text-gray-400 hover:text-gray-600';
+        const icon = document.createElement('i');
+        icon.className = 'fas fa-times';
+        close.append(icon);
+        close.addEventListener('click', () => notification.remove());
+
+        row.append(body, close);
+        notification.append(row);
 
         this.container.prepend(notification);
         
@@ -160,26 +235,108 @@ class NotificationManager {
     }
 }
 
+// Message History Loader
+class MessageHistory {
+    constructor(container, button) {
+        this.container = container;
+        this.button = button;
+        this.before = container.dataset.before || null;
+        this.peer = container.dataset.peer || null;
+        this.loading = false;
+
+        if (container.dataset.hasOlder !== 'true') {
+            this.button.classList.add('hidden');
+        }
+        this.button.addEventListener('click', () => this.loadOlder());
+    }
+
+    loadOlder() {
+        if (this.loading || !this.before) return;
+        this.loading = true;
+
+        const params = new URLSearchParams({ before: this.before });
+        if (this.peer) params.set('with', this.peer);
+
+        fetch(`/api/messages?${params}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) return;
+
+                // Windows arrive oldest first, so prepend in reverse
+                data.messages.slice().reverse().forEach(msg => {
+                    this.container.prepend(this.renderMessage(msg));
+                });
+                this.before = data.before;
+                if (!data.has_older) {
+                    this.button.classList.add('hidden');
+                }
+            })
+            .finally(() => {
+                this.loading = false;
+            });
+    }
+
+    renderMessage(msg) {
+        const item = document.createElement('div');
+        item.className = 'message-item';
+        item.dataset.id = msg.id;
+
+        const meta = document.createElement('p');
+        meta.className = 'text-sm text-gray-600';
+        meta.textContent = `${msg.sender_username} → ${msg.receiver_username} · ${msg.sent_at}`;
+
+        const body = document.createElement('p');
+        body.className = 'message-content';
+        body.textContent = msg.encrypted_content;
+
+        item.append(meta, body);
+        return item;
+    }
+}
+
 // Initialize components
 document.addEventListener('DOMContentLoaded', () => {
     // Initialize network graph if container exists
     const graphContainer = document.getElementById('network-graph');
     if (graphContainer) {
         const graph = new NetworkGraph(graphContainer);
-        fetch('/api/network-data')
-            .then(response => response.json())
-            .then(data => graph.drawGraph(data));
+        graph.load();
+
+        // Admin connections receive topology changes as they are committed
+        if (typeof io !== 'undefined') {
+            const graphSocket = io();
+            graphSocket.on('graph_changes', feed => {
+                if (!graph.data || feed.version <= graph.logVersion) return;
+                // Large batches arrive as a version only; fetch them instead
+                if (feed.changes.length) graph.applyChanges(feed.changes);
+                else graph.catchUp();
+            });
+            graphSocket.on('connect', () => {
+                if (graph.data) graph.catchUp();
+            });
+        }
+    }
+
+    // Load older message windows on demand
+    const historyContainer = document.getElementById('message-history');
+    const loadOlderButton = document.getElementById('load-older-messages');
+    if (historyContainer && loadOlderButton) {
+        new MessageHistory(historyContainer, loadOlderButton);
     }
 
     // Initialize notification manager
     const notificationManager = new NotificationManager();
     
-    // Setup WebSocket for real-time updates
-    const ws = new WebSocket(`ws://${window.location.host}/ws`);
-    ws.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        if (data.type === 'notification') {
-            notificationManager.addNotification(data.message);
-        }
-    };
+    // Receive new messages over SocketIO; the server places this
+    // connection in our user room when it connects
+    if (typeof io !== 'undefined') {
+        const socket = io();
+        socket.on('new_message', (data) => {
+            notificationManager.updateBadge(data.unread_count);
+            notificationManager.addNotification(
+                `New message from ${data.message.sender_username || 'node ' + data.message.sender_id}`
+            );
+            document.dispatchEvent(new CustomEvent('message:new', { detail: data.message }));
+        });
+    }
 });
\ No newline at end of file
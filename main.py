@@ -4,7 +4,7 @@ from flask_socketio import SocketIO
 from config import config
 from frontend._init_ import frontend
 from backend._init_ import create_app
-from .backend.database import init_db
+from backend.database import remove_session
 
 def create_main_app(config_name=None):
     # Determine configuration to use
@@ -17,18 +17,19 @@ def create_main_app(config_name=None):
     # Load configuration
     app.config.from_object(config[config_name])
     
-    # Initialize database
-    init_db()
-    
     # Initialize SocketIO
     socketio = SocketIO(app, cors_allowed_origins="*")
     
     # Register blueprints
     app.register_blueprint(frontend)
     
-    # Initialize backend
-    backend_app = create_app(app.config)
+    # Initialize backend (this also initializes the database and the
+    # SocketIO message push)
+    backend_app = create_app(app.config, socketio=socketio)
     app.register_blueprint(backend_app)
+
+    # Release each request's database session back to the pool
+    app.teardown_appcontext(remove_session)
     
     # Error handlers
     @app.errorhandler(404)